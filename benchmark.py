@@ -0,0 +1,145 @@
+'''
+    Offline benchmark of the export pipeline against simulator.SimulatedTradeApp and a stub FX server:
+    connect, accounts, orders, fx, contracts, compute and write, end to end, repeated to get tail latencies.
+    Also checks the cold import time of the pipeline modules against a budget.
+
+        python benchmark.py --accounts 50 --positions 200 --latency 0.002 --repeat 5
+'''
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+import utils
+from metrics import metrics
+from output import writeAccount
+from scheduler import RATE, RequestScheduler
+from simulator import SimulatedTradeApp, StubFxServer
+from utils import SetupLogger, ibConnect, getAccounts, getOpenOrders, getCurrencies, getAssetDetails, ibDisconnect, computeThings
+from cachedcontracts import CachedContracts
+
+logger = logging.getLogger()
+
+BaseCur = ['USD', 'CHF', 'EUR']
+IMPORT_BUDGET = 0.15  # seconds to import the modules ib2csv.py uses, in a fresh interpreter
+HEAVY = ['polars', 'requests', 'lxml']  # only loaded when first used
+
+IMPORT_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import utils, output, records, wrapper, history, daemon, gateways, replay
+elapsed = time.perf_counter() - start
+loaded = [name for name in %r if name in sys.modules]
+print(json.dumps({'seconds': elapsed, 'loaded': loaded}))
+'''
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def importTime() -> Dict[str, Any]:
+    '''
+        Import time of the pipeline modules in a fresh interpreter, and the heavy modules that import already loaded.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = subprocess.run([sys.executable, "-c", IMPORT_PROBE % HEAVY], cwd=here, capture_output=True, text=True, check=True)
+    return json.loads(probe.stdout.strip().splitlines()[-1])
+
+
+def runOnce(args: argparse.Namespace, workdir: str, stub: StubFxServer, cold: bool) -> Dict[str, float]:
+    '''
+        One export run; returns the wall time of each phase plus 'total'.
+    '''
+    if cold:  # empty caches, every contract and rate is fetched
+        for name in ("bench_fx.bin", "bench_contracts.bin"):
+            if os.path.exists(os.path.join(workdir, name)):
+                os.remove(os.path.join(workdir, name))
+    utils.forex_api = stub.frankfurter(os.path.join(workdir, "bench_fx.bin"))
+    utils.contract_db = CachedContracts(os.path.join(workdir, "bench_contracts.bin"))
+    metrics.reset()
+    start = time.perf_counter()
+
+    def factory() -> SimulatedTradeApp:
+        app = SimulatedTradeApp(args.accounts, args.positions, args.orders, args.contracts, args.latency, set(args.unpriced))
+        app.scheduler = RequestScheduler(app, rate=args.rate)
+        return app
+
+    app = ibConnect("simulator", factory=factory)
+    if app is None:
+        raise RuntimeError("simulated connection failed")
+    getAccounts(app)
+    getOpenOrders(app)
+    getCurrencies(app, BaseCur)
+    getAssetDetails(app)
+    ibDisconnect(app)
+    frames = computeThings(app, BaseCur)
+    for account, df in frames.items():
+        writeAccount(df, os.path.join(workdir, account), args.format)
+
+    times = {name: stats['wall_seconds'] for name, stats in metrics.report()['phases'].items()}
+    times['total'] = time.perf_counter() - start
+    utils.forex_api.close()
+    utils.contract_db.close()
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the export pipeline on a simulated TWS.")
+    parser.add_argument("--accounts", type=int, default=5)
+    parser.add_argument("--positions", type=int, default=200, help="positions per account")
+    parser.add_argument("--orders", type=int, default=10, help="live orders per account")
+    parser.add_argument("--contracts", type=int, default=2000, help="size of the contract universe positions are drawn from")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated TWS latency per answer, in seconds")
+    parser.add_argument("--rate", type=float, default=RATE,
+                        help="request pacing in messages/s, TWS' limit by default; raise it to measure the client alone")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="stub Frankfurter/FAZ latency per call, in seconds")
+    parser.add_argument("--unpriced", nargs="*", default=["HKD", "SEK"], help="currencies TWS does not quote (web fallback)")
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet", "ipc"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warm", action="store_true", help="keep the caches between runs instead of starting cold")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET,
+                        help="fail if importing the pipeline modules takes longer, in seconds")
+    args = parser.parse_args()
+    SetupLogger("ERROR")
+
+    imports = importTime()
+    print(f"import: {imports['seconds']:.3f}s (budget {args.import_budget}s)"
+          + (f", eagerly loaded: {', '.join(imports['loaded'])}" if imports['loaded'] else ""))
+
+    stub = StubFxServer(args.http_latency)
+    runs: List[Dict[str, float]] = list()
+    with tempfile.TemporaryDirectory(prefix="ib2csv-bench-") as workdir:
+        for n in range(args.repeat):
+            runs.append(runOnce(args, workdir, stub, cold=not args.warm or n == 0))
+    stub.close()
+
+    lines = args.accounts * (args.positions + args.orders)
+    phases = list(dict.fromkeys(name for run in runs for name in run))
+    results = {name: {'p50': percentile([run.get(name, 0.0) for run in runs], 50),
+                      'p95': percentile([run.get(name, 0.0) for run in runs], 95),
+                      'max': max(run.get(name, 0.0) for run in runs),
+                      'mean': statistics.fmean(run.get(name, 0.0) for run in runs)} for name in phases}
+    print(f"{args.accounts} accounts, {lines} lines, latency {args.latency}s, {args.repeat} {'warm' if args.warm else 'cold'} runs")
+    print(f"{'phase':<12}{'p50':>10}{'p95':>10}{'max':>10}")
+    for name, stats in results.items():
+        print(f"{name:<12}{stats['p50']:>10.4f}{stats['p95']:>10.4f}{stats['max']:>10.4f}")
+    print(f"throughput: {lines / results['total']['p50']:.0f} lines/s (p50)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'parameters': vars(args), 'lines': lines, 'import': imports, 'phases': results}, f, indent=2)
+    if imports['seconds'] > args.import_budget or imports['loaded']:
+        print("import budget exceeded", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,42 +1,125 @@
-from time import time_ns, sleep
-from typing import Any, Optional
-from sqlitedict import SqliteDict
+from time import time, perf_counter
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+from collections import OrderedDict
+import atexit
+import pickle
+import sqlite3
+import threading
 import logging
 
 logger = logging.getLogger()
 
+_MISSING = object()  # remembers in memory that a key is absent from the DB
+BUSY_TIMEOUT = 2000  # ms to wait for another process' write lock before giving up (the cache is skipped then)
+
 
 class CachedApi:
-    def __init__(self, fullpath: str) -> None:
+    def __init__(self, fullpath: str, memory_size: int = 4096, commit_interval: float = 60.0, stale: float = 0.0) -> None:
+        '''
+            memory_size: max entries of the in-process LRU tier kept in front of SQLite
+            commit_interval: pending writes are committed at most commit_interval seconds after the first of them, at the end
+                of each download phase (flush) and at exit; the SQLite write lock is held until then
+            stale: seconds an expired entry may still be served by cache_fetch while it is refreshed in background
+        '''
         self.__fullpath = fullpath
-        self.__db: Optional[SqliteDict] = None
+        self.__db: Optional[sqlite3.Connection] = None
+        self.__mem: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()  # key -> (expiry epoch, value)
+        self.__memory_size = memory_size
+        self.__commit_interval = commit_interval
+        self.__dirty = 0
+        self.__timer: Optional[threading.Timer] = None
+        self.__lock = threading.RLock()
+        self.__refreshing: Set[str] = set()
+        self.stale = stale
+        self.hits = 0
+        self.stale_hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.commits = 0
+        self.get_seconds = 0.0
         logger.debug("Initializing cache at %s", self.__fullpath)
 
     def open_db(self) -> None:
         """Open the database and perform cleanup of expired entries."""
         logger.warning("Opening DB %s", self.__fullpath)
-        self.__db = SqliteDict(self.__fullpath)
+        self.__db = sqlite3.connect(self.__fullpath, check_same_thread=False)
+        self.__db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+        try:  # readers of other processes are not blocked by a pending write
+            self.__db.execute("PRAGMA journal_mode = WAL")
+        except sqlite3.OperationalError as ee:
+            logger.warning("DB %s: cannot switch to WAL: %s", self.__fullpath, ee)
+        try:
+            self.__db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL NOT NULL, value BLOB)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self.__db.commit()
+        except sqlite3.OperationalError as ee:  # new file being created by another process: memory only for this run
+            logger.warning("DB %s: cannot create the cache table, not persisted this run: %s", self.__fullpath, ee)
+            self.__db.close()
+            self.__db = None
+            return
+        if self.__db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unnamed'").fetchone():
+            try:
+                self.__db.execute("DROP TABLE unnamed")  # former SqliteDict storage
+            except sqlite3.OperationalError as ee:
+                logger.warning("DB %s: cannot drop the former SqliteDict table: %s", self.__fullpath, ee)
         self._cleanup_expired_entries()
+        self.flush()
+        atexit.register(self.close)
+
+    def flush(self) -> None:
+        """Commit pending writes in one transaction, releasing the write lock."""
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            if self.__db is not None and (self.__dirty or self.__db.in_transaction):  # even a DELETE of nothing holds the lock
+                try:
+                    self.__db.commit()
+                    self.commits += 1
+                    logger.debug("DB %s: committed %d writes", self.__fullpath, self.__dirty)
+                except sqlite3.OperationalError as ee:
+                    logger.warning("DB %s: cannot commit, %d writes lost: %s", self.__fullpath, self.__dirty, ee)
+                    self.__db.rollback()
+            self.__dirty = 0
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__db is not None:
+                self.flush()
+                self.__db.close()
+                self.__db = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/latency counters of this cache."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'commits': self.commits,
+            'get_seconds': self.get_seconds,
+            'get_mean_us': self.get_seconds / lookups * 1e6 if lookups else 0.0,
+        }
 
     def _cleanup_expired_entries(self) -> None:
-        """Remove expired cache entries."""
-        if not self.__db:
+        """Remove expired cache entries; only takes the write lock when there are some, and skipped if the DB is busy."""
+        if self.__db is None:
             return
-        removed = 0
-        kept = 0
-        for key in list(self.__db.keys()):
+        limit = time() - self.stale
+        with self.__lock:
+            if not self.__db.execute("SELECT 1 FROM cache WHERE expires < ? LIMIT 1", (limit,)).fetchone():
+                return
             try:
-                counter, period, _ = key.split("\t", 2)
-                current = int(time_ns() / 1_000_000_000 / int(period))
-                if current - int(counter) > 1:
-                    del self.__db[key]
-                    removed += 1
-                else:
-                    kept += 1
-            except ValueError:
-                # Invalid key format, skip
-                pass
-        logger.debug("DB cleanup: keeping %d items, removed %d items", kept, removed)
+                removed = self.__db.execute("DELETE FROM cache WHERE expires < ?", (limit,)).rowcount
+            except sqlite3.OperationalError as ee:
+                logger.warning("DB %s: expired entries kept for now: %s", self.__fullpath, ee)
+                self.__db.rollback()
+                return
+            self.__dirty += removed
+        logger.debug("DB cleanup: removed %d items", removed)
 
 
     def __del__(self) -> None:
@@ -51,16 +134,83 @@ class CachedApi:
             period: Cache period in seconds.
 
         Returns:
-            Cached value or None if not found.
+            Cached value or None if not found or expired.
         """
-        result = None
-        idx = self._get_idx(key, period)
-        try:
-            result = self.__db[idx]  # type: ignore
-        except KeyError:
-            sleep(0.1)  # Brief pause on miss
+        expires, result = self._lookup(key, period)
+        if result is not _MISSING and expires > time():
+            return result
+        return None
+
+    def cache_fetch(self, key: str, period: int, fetch: Callable[[], Any]) -> Any:
+        """
+        Retrieve a value from cache, calling fetch() to compute and store it when needed.
+
+        An entry expired for less than `stale` seconds is returned as is, and refreshed by
+        a background thread so that callers never all wait on the upstream at expiry time.
+
+        Args:
+            key: Cache key.
+            period: Cache period in seconds.
+            fetch: Returns the up-to-date value; exceptions propagate to the caller on a miss.
+
+        Returns:
+            Cached or freshly fetched value.
+        """
+        expires, result = self._lookup(key, period)
+        now = time()
+        if result is not _MISSING:
+            if expires > now:
+                return result
+            if now - expires < self.stale:
+                with self.__lock:
+                    self.stale_hits += 1
+                    refresh = key not in self.__refreshing
+                    self.__refreshing.add(key)
+                if refresh:
+                    # daemon: a hung upstream must not delay the interpreter exit, a killed refresh only loses its write
+                    threading.Thread(target=self._revalidate, args=(key, period, fetch), name=f"revalidate {key}", daemon=True).start()
+                return result
+        result = fetch()
+        self.cache_set(key, period, result)
         return result
 
+    def _revalidate(self, key: str, period: int, fetch: Callable[[], Any]) -> None:
+        try:
+            self.cache_set(key, period, fetch())
+            self.flush()
+            logger.debug("DB %s: refreshed stale entry %s", self.__fullpath, key)
+        except BaseException as ee:
+            logger.warning("DB %s: cannot refresh stale entry %s: %s", self.__fullpath, key, ee)
+        finally:
+            with self.__lock:
+                self.__refreshing.discard(key)
+
+    def _lookup(self, key: str, period: int) -> Tuple[float, Any]:
+        """Return (expiry epoch, value) of an entry, value is _MISSING if unknown."""
+        start = perf_counter()
+        with self.__lock:
+            entry = self.__mem.get(key)
+            if entry is not None and entry[0] > time():
+                self.__mem.move_to_end(key)
+                self.memory_hits += 1
+            else:
+                entry = (time() + period, _MISSING)
+                if self.__db is not None:
+                    try:
+                        row = self.__db.execute("SELECT expires, value FROM cache WHERE key = ?", (key,)).fetchone()
+                    except sqlite3.OperationalError as ee:  # busy: a miss
+                        logger.warning("DB %s: cannot read %s: %s", self.__fullpath, key, ee)
+                        row = None
+                    if row is not None:
+                        entry = (row[0], pickle.loads(row[1]))
+                self._remember(key, entry)
+            if entry[1] is _MISSING or entry[0] + self.stale <= time():
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.get_seconds += perf_counter() - start
+        return entry
+
     def cache_set(self, key: str, period: int, value: Any) -> None:
         """
         Store a value in cache.
@@ -70,11 +220,27 @@ class CachedApi:
             period: Cache period in seconds.
             value: Value to cache.
         """
-        idx = self._get_idx(key, period)
-        self.__db[idx] = value  # type: ignore
-        self.__db.commit()  # type: ignore
-
-    def _get_idx(self, key: str, period: int) -> str:
-        """Generate cache index."""
-        counter = int(time_ns() / 1_000_000_000 / period)
-        return f"{counter}\t{period}\t{key}"
+        expires = time() + period
+        with self.__lock:
+            self._remember(key, (expires, value))
+            if self.__db is None:
+                return
+            try:
+                self.__db.execute("INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)",
+                                  (key, expires, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            except sqlite3.OperationalError as ee:  # locked by another process: only kept in memory
+                logger.warning("DB %s: cannot store %s: %s", self.__fullpath, key, ee)
+                return
+            self.writes += 1
+            self.__dirty += 1
+            if self.__timer is None:  # bounds the time the write lock is held even if no flush() comes
+                self.__timer = threading.Timer(self.__commit_interval, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def _remember(self, key: str, entry: Tuple[float, Any]) -> None:
+        """Keep an entry in the memory tier."""
+        self.__mem[key] = entry
+        self.__mem.move_to_end(key)
+        while len(self.__mem) > self.__memory_size:
+            self.__mem.popitem(last=False)
@@ -0,0 +1,36 @@
+import logging
+import os
+from dataclasses import asdict
+from typing import Optional
+from cachedApi import CachedApi
+from records import ContractInfo
+
+logger = logging.getLogger()
+
+TTL = int(os.getenv("IB_CONTRACT_TTL") or 30 * 24 * 3600)  # contract metadata seldom changes
+
+
+class CachedContracts(CachedApi):
+    '''
+        Contract metadata (longName, industry, priceMagnifier, minTick, ...) keyed by IB conId.
+    '''
+    def __init__(self, file: str, ttl: int = TTL):
+        super().__init__(file)
+        super().open_db()
+        self.ttl = ttl
+        logger.debug(f"contract store setup done (ttl {ttl}s)")
+
+    def __del__(self):
+        super().__del__()
+        logger.debug(f"Instance {self} destroyed.")
+
+    def get(self, conId: int) -> Optional[ContractInfo]:
+        """Return the cached metadata of a contract, None if unknown or stale."""
+        if not conId:
+            return None
+        details = self.cache_get(f"contract{conId}", self.ttl)
+        return ContractInfo(**details) if details is not None else None
+
+    def set(self, conId: int, details: ContractInfo) -> None:
+        if conId:
+            self.cache_set(f"contract{conId}", self.ttl, asdict(details))  # stored as a plain dict
@@ -1,12 +1,20 @@
 import logging
 from cachedApi import CachedApi
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
 import json
-from lxml import html
+import threading
+from concurrent.futures import Future, wait
+from queue import Empty, SimpleQueue
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
 
 logger = logging.getLogger()
 
+UNRESOLVED = -8.0  # conversion still running when the deadline of convert_many expired
+
 class CachedFrankfurter(CachedApi):
     iso4217 = {"AED":784, "AFN":971, "ALL":8, "AMD":51, "AOA":973, "ARS":32, "AUD":36, "AWG":533, "AZN":944, "BAM":977, "BBD":52, "BDT":50, 
            "BGN":975, "BHD":48, "BIF":108, "BMD":60, "BND":96, "BOB":68, "BOV":984, "BRL":986, "BSD":44, "BTN":64, "BWP":72, "BYN":933, 
@@ -25,15 +33,52 @@ class CachedFrankfurter(CachedApi):
            "XAD":396, "XAF":950, "XAG":961, "XAU":959, "XBA":955, "XBB":956, "XBC":957, "XBD":958, "XCD":951, "XCG":532, "XDR":960, 
            "XOF":952, "XPD":964, "XPF":953, "XPT":962, "XSU":994, "XTS":963, "XUA":965, "XXX":999, "YER":886, "ZAR":710, "ZMW":967, "ZWG":924}
     
-    def __init__(self, file: str):
-        super().__init__(file)
+    API_URL = "https://api.frankfurter.app/latest"
+    WWW_URL = "https://www.faz.net/aktuell/finanzen/boersen-maerkte/snippet.htn"
+
+    def __init__(self, file: str, api_url: Optional[str] = None, www_url: Optional[str] = None,
+                 timeout: Tuple[float, float] = (3.05, 10.0), retries: int = 2, backoff: float = 0.5, pool_size: int = 8,
+                 stale: float = 12*3600):
+        '''
+            api_url, www_url: endpoints, overridable to point to a local stub server
+            timeout: (connect, read) timeouts in seconds of every HTTP call
+            retries, backoff: bounded retries on connection errors and 429/5xx, sleeping backoff * 2^n in between
+            pool_size: max keep-alive connections kept per host
+            stale: seconds a day-old rate is still served while being refreshed in background
+        '''
+        super().__init__(file, stale=stale)
         super().open_db()
+        self.api_url = api_url or self.API_URL
+        self.www_url = www_url or self.WWW_URL
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.latencies: List[Tuple[str, float]] = list()  # (url, seconds) of every HTTP call
+        self.latencies_lock = threading.Lock()
+        self.rates_lock = threading.Lock()  # concurrent conversions share one download of each rate table
         logger.debug(f"frankfurter.app setup done")
         
     def __del__(self):
         super().__del__()
         logger.debug(f"Instance {self} destroyed.")
     
+    def http_get(self, url: str, params: Dict[str, Any]) -> requests.Response:
+        start = perf_counter()
+        try:
+            response = self.session.get(url, params=params, timeout=self.timeout)
+        finally:
+            elapsed = perf_counter() - start
+            with self.latencies_lock:
+                self.latencies.append((url, elapsed))
+            logger.debug("GET %s %s took %.3fs", url, params, elapsed)
+        response.raise_for_status()
+        return response
+
+
     def convert(self, what: str, inwhat: str):
         rate = self.convert_with_api(what, inwhat)
         if rate < 0.0:
@@ -47,20 +92,15 @@ class CachedFrankfurter(CachedApi):
         if sw and zw:
             if sw != zw:
                 k = f"convertwww{what}{inwhat}"
-                html_content = self.cache_get(k, 24*3600)
-                if html_content is None:
-                    url = 'https://www.faz.net/aktuell/finanzen/boersen-maerkte/snippet.htn'
-                    params = {
-                        'betrag': 10000,
-                        'swaehrung': sw,
-                        'zwaehrung': zw,
-                        'ajax': 6
-                    }
-                    response = requests.get(url, params=params)
-                    response.raise_for_status()
-                    html_content = response.text
-                    self.cache_set(k, 24*3600, html_content)
+                params = {
+                    'betrag': 10000,
+                    'swaehrung': sw,
+                    'zwaehrung': zw,
+                    'ajax': 6
+                }
+                html_content = self.cache_fetch(k, 24*3600, lambda: self.http_get(self.www_url, params).text)
                 if html_content is not None:    
+                    from lxml import html  # only needed when the API does not know a currency
                     tree = html.fromstring(html_content)
                     span_element = tree.xpath('//span[@class="bigone"]')[0]
                     text = span_element.text_content().strip().split()[0]
@@ -73,50 +113,126 @@ class CachedFrankfurter(CachedApi):
         else:
             r = -7.0
         
-        logger.debug(f"FAZ WWW convert currency {what} in {inwhat} > {r}")    
+        logger.debug("FAZ WWW convert currency %s in %s > %s", what, inwhat, r)    
         return r
     
     
-    def convert_with_api(self, what: str, inwhat: str):
-        k = f"convert10{what}{inwhat}"
-        r = self.cache_get(k, 24*3600)
-        if r is None:
+    def rates(self, base: str) -> Any:
+        """
+        Retrieve every rate quoted by frankfurter.app for a base currency in one request.
+
+        Args:
+            base: ISO code of the base currency.
+
+        Returns:
+            Dict of units of each currency for 1 base (base included), or a negative error code.
+        """
+        base = base.upper()
+        k = f"rates{base}"
+        with self.rates_lock:
+            r = self.fetch_rates(k, base)
+        return self.parse_rates(r, base)
+
+
+    def fetch_rates(self, k: str, base: str) -> Any:
+        def download() -> Any:
             try:
-                url = f"https://api.frankfurter.app/latest"
                 params = {
-                    "amount": 10000,
-                    "from": what.upper(),
-                    "to": inwhat.upper()
+                    "from": base,
                 }
-                response = requests.get(url, params=params)
-                response.raise_for_status()
-                r = response.text
-                self.cache_set(k, 24*3600, r)
+                return self.http_get(self.api_url, params).text
             except HTTPError as ee:
-                r = -2.0
-                code = ee.response.status_code
-                if code == 404:
-                    self.cache_set(k, 24*3600, r)  # we store in cache the 404 error since it won't change any soon
-                else:
-                    logger.info(f"FAZ API {ee}, unexpected code {code}")
-            except BaseException as ee:
-                logger.warning(f"FAZ API other error {ee}")
-                r = -4.0
-                
+                if ee.response.status_code == 404:
+                    return -2.0  # we store in cache the 404 error since it won't change any soon
+                raise
+
+        try:
+            r = self.cache_fetch(k, 24*3600, download)
+        except HTTPError as ee:
+            r = -2.0
+            logger.info(f"FAZ API {ee}, unexpected code {ee.response.status_code}")
+        except BaseException as ee:
+            logger.warning(f"FAZ API other error {ee}")
+            r = -4.0
+        return r
+
+
+    def parse_rates(self, r: Any, base: str) -> Any:
+        if isinstance(r, float):
+            return r
         if r is None or not isinstance(r, str):
-            r = -5.0
-        else:
+            return -5.0
+        try:
+            data = json.loads(r)
+            table = {cur: float(rate) for cur, rate in data["rates"].items() if isinstance(rate, (int, float))}
+            table[base] = 1.0
+        except BaseException as ee:
+            logger.error(f"cache error {ee}")
+            return -4.0
+        logger.debug("FAZ API rates for %s: %s", base, table)
+        return table
+
+
+    def convert_with_api(self, what: str, inwhat: str):
+        what, inwhat = what.upper(), inwhat.upper()
+        r = -2.0
+        # cross rate from the table of the target currency, or from the EUR one (ECB reference) if unsupported
+        for base in dict.fromkeys([inwhat, "EUR"]):
+            table = self.rates(base)
+            if not isinstance(table, dict):
+                r = table
+            elif what in table and inwhat in table:
+                r = table[what] / table[inwhat]
+                break
+        logger.debug("FAZ API convert currency %s in %s > %s", what, inwhat, r)
+        return r
+
+
+    def convert_many(self, whats: List[str], inwhat: str, timeout: Optional[float] = None) -> Dict[str, float]:
+        """
+        Convert several currencies concurrently; the API part costs a single request per base currency.
+
+        Args:
+            whats: Currencies to convert.
+            inwhat: Target currency.
+            timeout: Global deadline in seconds, conversions still running then are reported as UNRESOLVED.
+
+        Returns:
+            Units of each currency for 1 inwhat, negative if unknown.
+        """
+        result = dict()
+        if not whats:
+            return result
+        futures: Dict[Future, str] = {Future(): what for what in whats}
+        todo: "SimpleQueue[Tuple[Future, str]]" = SimpleQueue()
+        for future, what in futures.items():
+            todo.put((future, what))
+
+        def worker() -> None:
+            while True:
+                try:
+                    future, what = todo.get_nowait()
+                except Empty:
+                    return
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(self.convert(what, inwhat))
+                except BaseException as ee:
+                    future.set_exception(ee)
+
+        # daemon threads: a call hanging past the deadline neither blocks the caller nor the interpreter exit
+        for n in range(min(8, len(whats))):
+            threading.Thread(target=worker, name=f"fx_{n}", daemon=True).start()
+        done, late = wait(futures, timeout=timeout)
+        for future in done:
+            what = futures[future]
             try:
-                data = json.loads(r)
-                logger.debug(f"FAZ API json  {data}")
-                r = data["rates"][inwhat.upper()]
-                if r and isinstance(r, str) or isinstance(r, int) or isinstance(r, float):
-                    r = 10000.0 / float(r)
-                else:
-                    logger.error(f"unknown reply {type(r)} ")
-                    r = -3.0
+                result[what] = future.result()
             except BaseException as ee:
-                logger.error(f"cache error {ee}")
-                r = -4.0
-        logger.debug(f"FAZ API convert currency {what} in {inwhat} > {r}")
-        return r
+                logger.warning(f"convert currency {what} in {inwhat} failed: {ee}")
+                result[what] = -4.0
+        for future in late:
+            future.cancel()  # not started yet
+            result[futures[future]] = UNRESOLVED
+        return result
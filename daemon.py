@@ -0,0 +1,98 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from lazy import lazyImport
+from wrapper import TradeApp
+from utils import TIMEOUT, getCurrencies, getOpenOrders, getAssetDetails, computeThings
+
+pl = lazyImport("polars")
+logger = logging.getLogger()
+
+
+def orderBook(app: TradeApp) -> Dict[str, Dict[int, Tuple[str, Optional[float], Optional[float]]]]:
+    '''
+        Live orders of every account: orderId -> (action, quantity, value).
+    '''
+    with app.lock:
+        return {account: {line.orderId: (line.orderAct, line.orderPos, line.orderVal) for line in lines if line.orderId is not None}
+                for account, lines in app.portfolios.items()}
+
+
+def refreshOpenOrders(app: TradeApp, timeout: float = TIMEOUT) -> Set[str]:
+    '''
+        Replaces the order lines of every account with the currently live orders,
+        marks and returns the accounts whose orders changed.
+    '''
+    before = orderBook(app)
+    with app.lock:
+        for lines in app.portfolios.values():
+            lines[:] = [line for line in lines if line.orderId is None]
+        app.orders.clear()
+    app.refreshingOrders = True
+    try:
+        getOpenOrders(app, timeout)
+    finally:
+        app.refreshingOrders = False
+    after = orderBook(app)
+    changed = {account for account in before.keys() | after.keys() if before.get(account, {}) != after.get(account, {})}
+    for account in changed:
+        app.markDirty(account)
+    return changed
+
+
+def runDaemon(app: TradeApp, BaseCur: List[str], publish: Callable[[Dict[str, pl.DataFrame]], None],
+              interval: float = 60.0, onChange: bool = False, stop: Optional[threading.Event] = None) -> None:
+    '''
+        Keeps the connection open with reqAccountUpdates subscribed, so that updatePortfolio and updateAccountValue
+        land in memory, and republishes the accounts that changed every `interval` seconds, or as soon as a change
+        arrives (at most once per `interval`) with onChange.
+        TWS streams a single account at a time: with several accounts the subscription moves to the next one
+        at every refresh, which downloads it again.
+        Runs until `stop` is set or the connection is lost.
+    '''
+    stop = stop or threading.Event()
+    accounts = list(app.accounts.keys())
+    if not accounts:
+        logger.error("No account to follow")
+        return
+    current = 0
+    app.scheduler.pace(lambda: app.reqAccountUpdates(True, accounts[current]))
+    logger.warning(f"Following account(s) {accounts}, refresh every {interval}s{' on change' if onChange else ''}")
+
+    known = set(app.currency.keys())  # currencies getCurrencies already tried to price
+    last = time.monotonic()
+    while not stop.is_set() and app.isConnected():
+        if onChange:
+            app.changed.wait(max(0.0, last + interval - time.monotonic()))
+            stop.wait(max(0.0, last + 1.0 - time.monotonic()))  # debounce bursts of updates
+        else:
+            stop.wait(max(0.0, last + interval - time.monotonic()))
+        if stop.is_set():
+            break
+        last = time.monotonic()
+
+        if len(accounts) > 1:
+            app.scheduler.pace(lambda: app.reqAccountUpdates(False, accounts[current]))
+            current = (current + 1) % len(accounts)
+            app.scheduler.pace(lambda: app.reqAccountUpdates(True, accounts[current]))
+        refreshOpenOrders(app)
+
+        dirty = app.takeDirty()
+        if not dirty:
+            continue
+        with app.lock:
+            unknown = {line.currency for account in dirty for line in app.portfolios.get(account, [])} - known
+        if unknown:
+            logger.warning(f"New currencies {unknown}, refreshing rates")
+            getCurrencies(app, BaseCur)
+            known = set(app.currency.keys()) | unknown
+        getAssetDetails(app, accounts=sorted(dirty))
+        publish(computeThings(app, BaseCur, sorted(dirty)))
+        logger.warning(f"Refreshed {sorted(dirty)} in {time.monotonic() - last:.2f}s")
+
+    if accounts:
+        app.scheduler.pace(lambda: app.reqAccountUpdates(False, accounts[current]))
+    if not app.isConnected():
+        logger.error("Connection to TWS lost, leaving daemon mode")
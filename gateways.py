@@ -0,0 +1,81 @@
+from __future__ import annotations
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from lazy import lazyImport
+from wrapper import TradeApp
+from utils import TIMEOUT, PORT, ibConnect, getAccounts, getOpenOrders, getCurrencies, getAssetDetails, ibDisconnect, computeThings
+
+pl = lazyImport("polars")
+logger = logging.getLogger()
+
+Target = Tuple[str, int, Optional[int]]  # (host, port, clientId)
+
+
+def parseTarget(spec: str) -> Target:
+    '''
+        host, host:port or host:port:clientId; port defaults to PORT and clientId to a time based one.
+    '''
+    parts = spec.split(":")
+    if not 1 <= len(parts) <= 3 or not parts[0]:
+        raise ValueError(f"bad target '{spec}', expected host[:port[:clientId]]")
+    port = int(parts[1]) if len(parts) > 1 and parts[1] else PORT
+    clientId = int(parts[2]) if len(parts) > 2 and parts[2] else None
+    return parts[0], port, clientId
+
+
+def pullTarget(target: Target, BaseCur: List[str], timeout: float = TIMEOUT) -> Tuple[TradeApp, Dict[str, pl.DataFrame]]:
+    '''
+        Full download of one TWS/IB Gateway instance, disconnected at the end.
+        The returned app keeps the downloaded data.
+    '''
+    host, port, clientId = target
+    app = ibConnect(host, port, clientId)
+    if app is None:
+        raise ConnectionError(f"cannot reach {host}:{port}")
+    try:
+        getAccounts(app, timeout)
+        getOpenOrders(app, timeout)
+        getCurrencies(app, BaseCur, timeout=timeout)
+        getAssetDetails(app, timeout)
+    finally:
+        ibDisconnect(app)
+    return app, computeThings(app, BaseCur)
+
+
+def pullTargets(targets: List[Target], BaseCur: List[str], timeout: float = TIMEOUT) -> Tuple[List[TradeApp], Dict[str, pl.DataFrame]]:
+    '''
+        Downloads several instances concurrently, one thread each: the wall time is the one of the slowest.
+        The frames of all the instances are merged by account; an unreachable instance is logged and skipped.
+
+        Returns:
+            The apps that answered, and the frame of every account.
+    '''
+    start = time.monotonic()
+    apps: List[TradeApp] = list()
+    frames: Dict[str, pl.DataFrame] = dict()
+    results: Dict[Target, Tuple[TradeApp, Dict[str, pl.DataFrame]]] = dict()
+    with ThreadPoolExecutor(max_workers=len(targets) or 1, thread_name_prefix="gateway") as pool:
+        futures = {pool.submit(pullTarget, target, BaseCur, timeout): target for target in targets}
+        for future in as_completed(futures):
+            host, port, _ = futures[future]
+            try:
+                results[futures[future]] = future.result()
+            except Exception as ee:
+                logger.error(f"{host}:{port} failed: {ee}")
+                continue
+            logger.warning(f"{host}:{port} done after {time.monotonic() - start:.2f}s, {len(results[futures[future]][1])} account(s)")
+
+    # merged in the order of the targets, whatever the order of completion
+    for target in targets:
+        if target not in results:
+            continue
+        app, result = results[target]
+        apps.append(app)
+        for account, df in result.items():
+            if account in frames:
+                logger.warning(f"Account {account} served by several instances, keeping the one of {target[0]}:{target[1]}")
+            frames[account] = df
+    logger.warning(f"{len(apps)}/{len(targets)} instance(s), {len(frames)} account(s) in {time.monotonic() - start:.2f}s")
+    return apps, frames
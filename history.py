@@ -0,0 +1,113 @@
+from __future__ import annotations
+from dataclasses import fields
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import logging
+import sqlite3
+from lazy import lazyImport
+from records import PortfolioLine
+
+pl = lazyImport("polars")
+logger = logging.getLogger()
+
+RowKey = Tuple[str, str, str]  # (kind, account, key)
+LINE_FIELDS = [f.name for f in fields(PortfolioLine) if f.name != 'details']
+
+
+def appRows(app: Any) -> Dict[RowKey, Dict[str, Any]]:
+    '''
+        Positions (by conId), live orders (by orderId) and FX rates (by currency) currently held by a TradeApp.
+    '''
+    rows = dict()
+    for account, lines in app.portfolios.items():
+        for line in lines:
+            payload = {name: getattr(line, name) for name in LINE_FIELDS}
+            if line.orderId is not None:
+                rows[('order', account, str(line.orderId))] = payload
+            else:
+                rows[('position', account, str(line.conId))] = payload
+    for cur, rate in app.currency.items():
+        rows[('fx', "", cur)] = {'rate': rate}
+    return rows
+
+
+class SnapshotStore:
+    '''
+        Append-only history of the exported data. Each snapshot only stores the rows that changed
+        since the previous one (a NULL payload records a removal); any past state is rebuilt by taking,
+        for every row key, its latest version not newer than the requested snapshot.
+    '''
+    def __init__(self, fullpath: str) -> None:
+        self.__fullpath = fullpath
+        self.__db = sqlite3.connect(fullpath, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, ts REAL NOT NULL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS snapshots_ts ON snapshots (ts)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS rows (kind TEXT NOT NULL, account TEXT NOT NULL, key TEXT NOT NULL, "
+                          "snapshot INTEGER NOT NULL, payload TEXT, PRIMARY KEY (kind, account, key, snapshot)) WITHOUT ROWID")
+        self.__db.commit()
+        logger.debug("Snapshot store at %s", self.__fullpath)
+
+    def close(self) -> None:
+        self.__db.close()
+
+    def snapshots(self) -> List[Tuple[int, float]]:
+        """(id, timestamp) of every recorded snapshot, oldest first."""
+        return self.__db.execute("SELECT id, ts FROM snapshots ORDER BY id").fetchall()
+
+    def record(self, rows: Dict[RowKey, Dict[str, Any]], ts: Optional[float] = None) -> int:
+        """
+        Record a snapshot, writing only the rows added, changed or removed since the previous one.
+
+        Args:
+            rows: Payload of every row, by (kind, account, key); see appRows.
+            ts: Epoch timestamp of the snapshot, now by default.
+
+        Returns:
+            Id of the new snapshot.
+        """
+        previous = self._state(None)
+        current = {k: json.dumps(v, sort_keys=True) for k, v in rows.items()}
+        changes = [(*k, payload) for k, payload in current.items() if previous.get(k) != payload]
+        changes += [(*k, None) for k in previous.keys() - current.keys()]
+        with self.__db:
+            snapshot = self.__db.execute("INSERT INTO snapshots (ts) VALUES (?)", (time() if ts is None else ts,)).lastrowid
+            self.__db.executemany("INSERT INTO rows (kind, account, key, snapshot, payload) VALUES (?, ?, ?, ?, ?)",
+                                  [(kind, account, key, snapshot, payload) for kind, account, key, payload in changes])
+        logger.warning(f"Snapshot {snapshot}: {len(changes)} changed rows out of {len(current)}")
+        return snapshot
+
+    def _state(self, at: Optional[float]) -> Dict[RowKey, str]:
+        """Latest payload of every row present at epoch `at` (now if None)."""
+        last = self.__db.execute("SELECT MAX(id) FROM snapshots WHERE ts <= ?", (float("inf") if at is None else at,)).fetchone()[0]
+        if last is None:
+            return dict()
+        query = ("SELECT r.kind, r.account, r.key, r.payload FROM rows r JOIN "
+                 "(SELECT kind, account, key, MAX(snapshot) AS snapshot FROM rows WHERE snapshot <= ? GROUP BY kind, account, key) m "
+                 "USING (kind, account, key, snapshot) WHERE r.payload IS NOT NULL")
+        return {(kind, account, key): payload for kind, account, key, payload in self.__db.execute(query, (last,))}
+
+    def snapshot(self, at: Optional[float] = None) -> Dict[str, pl.DataFrame]:
+        """
+        Rebuild the state at a point in time.
+
+        Args:
+            at: Epoch timestamp, latest snapshot if None.
+
+        Returns:
+            One frame per kind ('position', 'order', 'fx') with account, key and payload columns.
+        """
+        byKind: Dict[str, List[Dict[str, Any]]] = dict()
+        for (kind, account, key), payload in self._state(at).items():
+            byKind.setdefault(kind, []).append({'account': account, 'key': key, **json.loads(payload)})
+        return {kind: pl.from_dicts(rows, infer_schema_length=None) for kind, rows in byKind.items()}
+
+    def series(self, kind: str, account: str, key: str) -> pl.DataFrame:
+        """
+        Every recorded version of one row, oldest first; a removed row shows as a line of nulls.
+        """
+        query = ("SELECT s.ts, r.payload FROM rows r JOIN snapshots s ON s.id = r.snapshot "
+                 "WHERE r.kind = ? AND r.account = ? AND r.key = ? ORDER BY r.snapshot")
+        versions = [{'ts': ts, **(json.loads(payload) if payload is not None else {})}
+                    for ts, payload in self.__db.execute(query, (kind, account, key))]
+        return pl.from_dicts(versions, infer_schema_length=None) if versions else pl.DataFrame()
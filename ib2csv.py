@@ -1,18 +1,88 @@
-import logging
-import polars as pl
-import locale
+import argparse
 import os
 import sys
-from utils import SetupLogger, ibConnect, getAccounts, getOpenOrders, getCurrencies, getAssetDetails, ibDisconnect, computeThings
+from utils import LOG_LEVEL, LOG_QUEUE, SetupLogger, ibConnect, getAccounts, getOpenOrders, getCurrencies, getAssetDetails, iterAssetDetails, ibDisconnect, computeThings
+from output import FORMATS, writeAccount, writeCombined
+from history import SnapshotStore, appRows
+from daemon import runDaemon
+from gateways import parseTarget, pullTargets
+from metrics import metrics, FORMATS as METRICS_FORMATS
+from replay import record, replay
+from wrapper import TradeApp
 
 
-logger = SetupLogger()
-logging.getLogger().setLevel(logging.DEBUG)
+parser = argparse.ArgumentParser(description="Download your Interactive Brokers portfolios, one CSV file per account.")
+parser.add_argument("--stream", action="store_true",
+                    help="write each account's file as soon as its contract details are known, instead of at the end")
+parser.add_argument("--format", choices=FORMATS.keys(), default="csv",
+                    help="csv (tab separated), parquet or ipc (Arrow/Feather) file per account, or combined: one Parquet file for all accounts")
+parser.add_argument("--compression", default="zstd", help="Parquet compression codec (zstd, snappy, lz4, gzip, uncompressed)")
+parser.add_argument("--history", metavar="FILE", help="also append the changes since the previous run to this snapshot store")
+parser.add_argument("--daemon", metavar="SECONDS", type=float,
+                    help="stay connected after the export and rewrite the accounts that changed every SECONDS")
+parser.add_argument("--on-change", action="store_true", help="in daemon mode, rewrite as soon as a change arrives (at most every SECONDS)")
+parser.add_argument("--targets", metavar="HOST:PORT:CLIENTID", nargs="+", type=parseTarget,
+                    help="download several TWS/IB Gateway instances concurrently and merge their accounts (port and clientId optional)")
+parser.add_argument("--log-level", default=LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper,
+                    help="WARNING by default (progress and problems); DEBUG traces every TWS callback and is much slower")
+parser.add_argument("--log-queue", action="store_true", default=LOG_QUEUE,
+                    help="format and write the log from a background thread")
+parser.add_argument("--metrics", choices=METRICS_FORMATS.keys(),
+                    help="also write the time spent per phase and the run counters to metrics.json or metrics.prom")
+parser.add_argument("--record", metavar="FILE", help="also record the TWS session to FILE (gzipped), for --replay")
+parser.add_argument("--replay", metavar="FILE", help="rebuild the data from a recorded session instead of connecting to TWS")
+args = parser.parse_args()
+if args.replay and (args.targets or args.stream or args.daemon is not None or args.record):
+    parser.error("--replay cannot be combined with --targets, --stream, --daemon or --record")
+metrics.enabled = args.metrics is not None
+if args.targets and (args.stream or args.daemon is not None or args.record):
+    parser.error("--targets cannot be combined with --stream, --daemon or --record")
+
+logger = SetupLogger(args.log_level, args.log_queue)
 
 ipaddr = os.getenv("IPADDR", "127.0.0.1")
 BaseCur = ['USD', 'CHF', 'EUR'] 
+combined = dict()
+
+
+def export(frames):
+    if args.format == 'combined':
+        combined.update(frames)
+    else:
+        for account, df in frames.items():
+            writeAccount(df, account, args.format, args.compression)
+
+
+if args.targets:
+    apps, frames = pullTargets(args.targets, BaseCur)
+    if not apps:
+        print("Cannot reach any of the instances.", file=sys.stderr)
+        sys.exit(-2)
+    export(frames)
+    if args.format == 'combined':
+        writeCombined(combined, args.compression)
+    if args.history:
+        store = SnapshotStore(args.history)
+        store.record({key: row for app in apps for key, row in appRows(app).items()})
+        store.close()
+    if args.metrics:
+        metrics.write(args.metrics)
+    sys.exit(0)
 
-app = ibConnect(ipaddr)
+if args.replay:
+    app = replay(args.replay)
+    export(computeThings(app, BaseCur))
+    if args.format == 'combined':
+        writeCombined(combined, args.compression)
+    if args.history:
+        store = SnapshotStore(args.history)
+        store.record(appRows(app))
+        store.close()
+    if args.metrics:
+        metrics.write(args.metrics)
+    sys.exit(0)
+
+app = ibConnect(ipaddr, factory=(lambda: record(TradeApp(), args.record)) if args.record else TradeApp)
 
 if app is None:
     print("Cannot reach instance. Please check the IP address to use and your Trader Workstation configuration.\n"
@@ -26,25 +96,44 @@ else:
         getAccounts(app)
         getOpenOrders(app)
         getCurrencies(app, BaseCur)
-        getAssetDetails(app)
 
+        if args.stream:
+            for account in iterAssetDetails(app):
+                export(computeThings(app, BaseCur, [account]))
+        else:
+            getAssetDetails(app)
+            if args.daemon is None:
+                ibDisconnect(app)
+            export(computeThings(app, BaseCur))
+
+        if args.format == 'combined':
+            writeCombined(combined, args.compression)
+
+        store = SnapshotStore(args.history) if args.history else None
+        if store:
+            store.record(appRows(app))
+
+        if args.daemon is not None:
+            def publish(frames):
+                export(frames)
+                if args.format == 'combined':
+                    writeCombined(combined, args.compression)
+                if store:
+                    store.record(appRows(app))
+                if args.metrics:
+                    metrics.write(args.metrics)
+            try:
+                runDaemon(app, BaseCur, publish, args.daemon, args.on_change)
+            except KeyboardInterrupt:
+                logger.warning("Interrupted, leaving daemon mode")
         ibDisconnect(app)
+        if app.recorder is not None:
+            app.recorder.close(app)
+        if store:
+            store.close()
+        if args.metrics:
+            metrics.write(args.metrics)
 
-        computeThings(app, BaseCur)
-        
-        for account in app.accounts:
-            df = pl.DataFrame(app.portfolios[account])
-            with pl.Config(
-                tbl_cell_numeric_alignment="RIGHT",
-                thousands_separator="",
-                decimal_separator=locale.localeconv()["decimal_point"],
-                float_precision=4,
-                set_tbl_column_data_type_inline=False,
-            ):
-                filename = f"{account}.csv"
-                logger.warning(f"Writing CSV file '{filename}'...") 
-                df.write_csv(file=filename, separator='\t', float_precision=4, null_value="")
-                
     except Exception as exe:
         logger.fatal(type(exe)) 
         sys.exit(-1)
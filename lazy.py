@@ -0,0 +1,42 @@
+import importlib
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+from typing import Any, Optional
+
+
+class LazyModule(ModuleType):
+    '''
+        Stands for module `name` until one of its attributes is used, then imports it under a lock
+        and takes its attributes, so that threads touching it at once all see the complete module.
+    '''
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.__lock = threading.Lock()
+        self.__module: Optional[ModuleType] = None
+
+    def __load(self) -> ModuleType:
+        with self.__lock:
+            if self.__module is None:
+                module = importlib.import_module(self.__name__)
+                self.__dict__.update({k: v for k, v in module.__dict__.items() if k not in ('__name__', '__spec__', '__loader__')})
+                self.__module = module
+            return self.__module
+
+    def __getattr__(self, attr: str) -> Any:  # only called for attributes not taken yet
+        if attr.startswith('_LazyModule__'):
+            raise AttributeError(attr)
+        return getattr(self.__load(), attr)
+
+
+def lazyImport(name: str) -> ModuleType:
+    '''
+        Returns module `name`, only imported on the first access to one of its attributes.
+        Modules using it for annotations need `from __future__ import annotations`.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    return LazyModule(name)
@@ -0,0 +1,172 @@
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from proxy import WrapperProxy
+
+logger = logging.getLogger()
+
+FORMATS = {'json': "json", 'prometheus': "prom"}
+PREFIX = "ib2csv"
+
+
+class CallbackCounter(WrapperProxy):
+    '''
+        Counts the callbacks of a TradeApp by name. Only the EReader thread of the app calls it.
+    '''
+    def __init__(self, wrapper: Any) -> None:
+        super().__init__(wrapper)
+        self.counts: Counter = Counter()
+
+    def hook(self, name: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> None:
+        self.counts[name] += 1
+
+
+class Metrics:
+    '''
+        Wall and CPU time per phase of a run, plus counters. Sources registered with register()
+        (cache stats, callback counters, ...) are only read when a report is made.
+    '''
+    def __init__(self) -> None:
+        self.enabled = False  # set when a report is wanted, turns the more costly probes on
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases: Dict[str, Dict[str, float]] = dict()
+        self.counters: Dict[str, float] = dict()
+        self.sources: List[Callable[[], Dict[str, float]]] = list()
+
+    def reset(self) -> None:
+        '''
+            Starts a new run: phases and counters are cleared, registered sources are kept.
+        '''
+        with self.lock:
+            self.started = time.time()
+            self.phases.clear()
+            self.counters.clear()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        '''
+            Times the enclosed block; CPU time is the one of the calling thread.
+        '''
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self.lock:
+                stats = self.phases.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+                stats['wall_seconds'] += wall
+                stats['cpu_seconds'] += cpu
+                stats['calls'] += 1
+
+    def timed(self, name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        '''
+            Decorator timing every call of a function as phase `name`.
+        '''
+        def decorate(function: Callable[..., Any]) -> Callable[..., Any]:
+            @functools.wraps(function)
+            def timed(*args: Any, **kwargs: Any) -> Any:
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return timed
+        return decorate
+
+    def count(self, name: str, n: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def register(self, source: Callable[[], Dict[str, float]]) -> None:
+        self.sources.append(source)
+
+    def callbacks(self, app: Any) -> CallbackCounter:
+        '''
+            Interposes a CallbackCounter between the app and its decoder; must be called before connect().
+        '''
+        proxy = CallbackCounter(app.wrapper)
+        app.wrapper = proxy
+        self.register(lambda: {f"callbacks.{name}": n for name, n in proxy.counts.items()})
+        return proxy
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Snapshot of the phases and counters.
+
+        Returns:
+            Dict with the run start epoch, run duration, phases by name and counters by dotted name.
+        """
+        counters: Dict[str, float] = dict()
+        for source in self.sources:
+            try:
+                for name, value in source().items():
+                    counters[name] = counters.get(name, 0) + value
+            except Exception as ee:
+                logger.warning(f"metrics source {source} failed: {ee}")
+        with self.lock:
+            counters.update({name: counters.get(name, 0) + value for name, value in self.counters.items()})
+            phases = {name: dict(stats) for name, stats in self.phases.items()}
+        return {'started': self.started, 'duration_seconds': time.time() - self.started, 'phases': phases,
+                'counters': dict(sorted(counters.items()))}
+
+    def write(self, fmt: str = 'json', basename: str = "metrics") -> str:
+        '''
+            Writes the report as JSON or as Prometheus text exposition (for the node exporter textfile collector),
+            returns the file name.
+        '''
+        filename = f"{basename}.{FORMATS[fmt]}"
+        report = self.report()
+        text = json.dumps(report, indent=2) if fmt == 'json' else prometheus(report)
+        with open(f"{filename}.tmp", "w") as tmp:
+            tmp.write(text)
+        os.replace(f"{filename}.tmp", filename)
+        logger.warning(f"Metrics written to '{filename}'")
+        return filename
+
+
+def sample(value: float) -> str:
+    '''
+        Exact text of a sample value: integers as such, floats with all their digits.
+    '''
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def metricName(name: str) -> Tuple[str, str]:
+    '''
+        Metric and `name` label of a dotted counter, one metric per unit: 'group.x_seconds' (or _us) and 'group.bytes'
+        become PREFIX_group_x_seconds and PREFIX_group_bytes, 'group_seconds.x' PREFIX_group_seconds{name="x"},
+        plain counts PREFIX_group_total{name="x"}.
+    '''
+    group, _, label = (re.sub(r'[^a-zA-Z0-9_.]', '_', part) for part in name.partition("."))
+    group = group.replace(".", "_")
+    if re.search(r'_(seconds|us)$', label) or label == 'bytes':
+        return f"{PREFIX}_{group}_{label.replace('.', '_')}", ""
+    if group.endswith('_seconds'):
+        return f"{PREFIX}_{group}", label
+    return f"{PREFIX}_{group}_total", label
+
+
+def prometheus(report: Dict[str, Any]) -> str:
+    '''
+        Counters are grouped by unit, see metricName; counts keep the rest of their name as a `name` label.
+    '''
+    lines = [f"# TYPE {PREFIX}_run_duration_seconds gauge", f"{PREFIX}_run_duration_seconds {sample(report['duration_seconds'])}"]
+    for stat in ('wall_seconds', 'cpu_seconds', 'calls'):
+        lines.append(f"# TYPE {PREFIX}_phase_{stat} gauge")
+        lines += [f'{PREFIX}_phase_{stat}{{phase="{name}"}} {sample(stats[stat])}' for name, stats in report['phases'].items()]
+    groups: Dict[str, List[str]] = dict()
+    for name, value in report['counters'].items():
+        metric, label = metricName(name)
+        groups.setdefault(metric, []).append(f'{metric}{{name="{label}"}} {sample(value)}' if label else f"{metric} {sample(value)}")
+    for metric, samples in groups.items():
+        lines.append(f"# TYPE {metric} gauge")
+        lines += samples
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
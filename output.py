@@ -0,0 +1,77 @@
+from __future__ import annotations
+import logging
+import locale
+import os
+from typing import Callable, Dict
+from lazy import lazyImport
+from metrics import metrics
+
+pl = lazyImport("polars")
+logger = logging.getLogger()
+
+# per account files: tab separated text, compressed Parquet, or uncompressed Arrow IPC (Feather v2, memory-mappable)
+# 'combined' writes every account in a single Parquet file, rows grouped by account
+FORMATS = {'csv': "csv", 'parquet': "parquet", 'ipc': "arrow", 'combined': "parquet"}
+COMBINED = "portfolios"
+
+
+def atomicWrite(filename: str, write: Callable[[str], None]) -> None:
+    '''
+        Writes through a temporary file renamed at the end,
+        so that readers and interrupted runs only ever see complete files.
+    '''
+    tmp = f"{filename}.tmp"
+    try:
+        with metrics.phase("write"):
+            write(tmp)
+            os.replace(tmp, filename)
+        metrics.count("output.files")
+        metrics.count("output.bytes", os.path.getsize(filename))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def writeCsv(df: pl.DataFrame, filename: str) -> None:
+    with pl.Config(
+        tbl_cell_numeric_alignment="RIGHT",
+        thousands_separator="",
+        decimal_separator=locale.localeconv()["decimal_point"],
+        float_precision=4,
+        set_tbl_column_data_type_inline=False,
+    ):
+        logger.warning(f"Writing CSV file '{filename}'...")
+        atomicWrite(filename, lambda tmp: df.write_csv(file=tmp, separator='\t', float_precision=4, null_value=""))
+
+
+def writeAccount(df: pl.DataFrame, account: str, fmt: str = 'csv', compression: str = "zstd") -> str:
+    '''
+        Writes the frame of one account in the given per account format, returns the file name.
+    '''
+    filename = f"{account}.{FORMATS[fmt]}"
+    if fmt == 'csv':
+        writeCsv(df, filename)
+    elif fmt == 'parquet':
+        logger.warning(f"Writing Parquet file '{filename}'...")
+        atomicWrite(filename, lambda tmp: df.write_parquet(tmp, compression=compression, statistics=True))
+    elif fmt == 'ipc':
+        logger.warning(f"Writing Arrow IPC file '{filename}'...")
+        atomicWrite(filename, lambda tmp: df.write_ipc(tmp, compression="uncompressed"))
+    else:
+        raise ValueError(f"unknown per account output format '{fmt}'")
+    return filename
+
+
+def writeCombined(frames: Dict[str, pl.DataFrame], compression: str = "zstd") -> str:
+    '''
+        Writes all the accounts in a single Parquet file with a leading 'account' column. Rows are kept
+        grouped by account so that the row group statistics let readers filtering on an account skip the others.
+    '''
+    filename = f"{COMBINED}.{FORMATS['combined']}"
+    if not frames:
+        return filename
+    df = pl.concat([frame.select(pl.lit(account, dtype=pl.String).alias('account'), pl.all()) for account, frame in frames.items()])
+    logger.warning(f"Writing Parquet file '{filename}' ({len(frames)} accounts)...")
+    atomicWrite(filename, lambda tmp: df.write_parquet(tmp, compression=compression, statistics=True))
+    return filename
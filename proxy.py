@@ -0,0 +1,22 @@
+from typing import Any, Dict, Tuple
+
+
+class WrapperProxy:
+    '''
+        Stands for the EWrapper of a TradeApp (app.wrapper, before connect): every callback the decoder dispatches
+        goes through hook() with its arguments, then on to the wrapped EWrapper. Proxies can be stacked.
+    '''
+    def __init__(self, wrapper: Any) -> None:
+        self.wrapper = wrapper
+
+    def hook(self, name: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.wrapper, name)
+        if not callable(attr):
+            return attr
+        def hooked(*args: Any, **kwargs: Any) -> Any:
+            self.hook(name, args, kwargs)
+            return attr(*args, **kwargs)
+        return hooked
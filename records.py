@@ -0,0 +1,136 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from lazy import lazyImport
+
+pl = lazyImport("polars")
+
+
+@dataclass(slots=True)
+class ContractInfo:
+    '''
+        Contract metadata extracted from a ContractDetails, shared by every line holding the contract.
+    '''
+    stockType: str = ""
+    longName: str = ""
+    industry: str = ""
+    category: str = ""
+    subcategory: str = ""
+    priceMagnifier: int = 1
+    minSize: float = 0.0001
+    sizeIncrement: float = 1.0
+    minTick: float = 0.0001
+
+
+@dataclass(slots=True)
+class PortfolioLine:
+    '''
+        A position (updatePortfolio), a live order (openOrder/orderStatus) or a TOTAL line of an account.
+    '''
+    symbol: Optional[str] = None
+    longName: Optional[str] = None
+    secType: str = ""
+    primaryExchange: Optional[str] = None
+    currency: str = ""
+    conId: Optional[int] = None
+    localSymbol: Optional[str] = None
+    position: Optional[float] = None
+    marketPrice: Optional[float] = None
+    marketValue: Optional[float] = None
+    averageCost: Optional[float] = None
+    unrealizedPNL: Optional[float] = None
+    realizedPNL: Optional[float] = None
+    orderAct: str = ""
+    orderId: Optional[int] = None
+    orderAlgoId: Optional[str] = None
+    orderRef: Optional[str] = None
+    orderType: Optional[str] = None
+    orderVal: Optional[float] = None
+    orderPos: Optional[float] = None
+    details: Optional[ContractInfo] = None
+
+
+# raw columns of the exported frames, in output order: position, contract, then order fields
+# (Polars dtypes, built on first use so that importing this module does not load Polars)
+SCHEMAS = ('POSITION_SCHEMA', 'CONTRACT_SCHEMA', 'ORDER_SCHEMA', 'SCHEMA')
+
+
+@lru_cache(maxsize=None)
+def schemas() -> Dict[str, Dict[str, pl.DataType]]:
+    POSITION_SCHEMA: Dict[str, pl.DataType] = {
+        'symbol': pl.String,
+        'longName': pl.String,
+        'secType': pl.String,
+        'primaryExchange': pl.String,
+        'currency': pl.String,
+        'conId': pl.Int64,
+        'localSymbol': pl.String,
+        'position': pl.Float64,
+        'marketPrice': pl.Float64,
+        'marketValue': pl.Float64,
+        'averageCost': pl.Float64,
+        'unrealizedPNL': pl.Float64,
+        'realizedPNL': pl.Float64,
+        'orderAct': pl.String,
+    }
+    CONTRACT_SCHEMA: Dict[str, pl.DataType] = {
+        'stockType': pl.String,
+        'industry': pl.String,
+        'category': pl.String,
+        'subcategory': pl.String,
+        'priceMagnifier': pl.Int64,
+        'minSize': pl.Float64,
+        'sizeIncrement': pl.Float64,
+        'minTick': pl.Float64,
+    }
+    ORDER_SCHEMA: Dict[str, pl.DataType] = {
+        'orderId': pl.Int64,
+        'orderAlgoId': pl.String,
+        'orderRef': pl.String,
+        'orderType': pl.String,
+        'orderVal': pl.Float64,
+        'orderPos': pl.Float64,
+    }
+    SCHEMA: Dict[str, pl.DataType] = {'account': pl.String, **POSITION_SCHEMA, **CONTRACT_SCHEMA, **ORDER_SCHEMA}
+    return {'POSITION_SCHEMA': POSITION_SCHEMA, 'CONTRACT_SCHEMA': CONTRACT_SCHEMA, 'ORDER_SCHEMA': ORDER_SCHEMA, 'SCHEMA': SCHEMA}
+
+
+def __getattr__(name: str) -> Any:
+    if name in SCHEMAS:
+        return schemas()[name]
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+# amounts converted in every base currency by computeThings
+CONVERTED = ['marketPrice', 'marketValue', 'averageCost',  'unrealizedPNL', 'realizedPNL', 'orderVal']
+
+
+def outputSchema(BaseCur: List[str]) -> Dict[str, pl.DataType]:
+    '''
+        Columns of the exported frames, in order: position and contract fields, converted amounts, weight,
+        then order fields and converted order values.
+    '''
+    POSITION_SCHEMA, CONTRACT_SCHEMA, ORDER_SCHEMA = (schemas()[name] for name in SCHEMAS[:3])
+    schema = {**POSITION_SCHEMA, **CONTRACT_SCHEMA}
+    schema.update({f"{column}.{currency}": pl.Float64 for column in CONVERTED if column != 'orderVal' for currency in BaseCur})
+    schema['pct'] = pl.Float64
+    schema.update(ORDER_SCHEMA)
+    schema.update({f"orderVal.{currency}": pl.Float64 for currency in BaseCur})
+    return schema
+
+
+def toFrame(portfolios: Dict[str, List[PortfolioLine]]) -> pl.DataFrame:
+    '''
+        Column-oriented build of the lines of several accounts, typed by SCHEMA without inference.
+    '''
+    POSITION_SCHEMA, CONTRACT_SCHEMA, ORDER_SCHEMA, SCHEMA = (schemas()[name] for name in SCHEMAS)
+    lines = [line for account in portfolios for line in portfolios[account]]
+    columns = {'account': [account for account in portfolios for _ in portfolios[account]]}
+    for name in POSITION_SCHEMA.keys() | ORDER_SCHEMA.keys():
+        columns[name] = [getattr(line, name) for line in lines]
+    for name in CONTRACT_SCHEMA.keys():
+        columns[name] = [getattr(line.details, name) if line.details is not None else None for line in lines]
+    # the full name comes with the contract details, the symbol stands for it until then
+    columns['longName'] = [line.details.longName if line.details is not None else line.longName for line in lines]
+    return pl.DataFrame({name: columns[name] for name in SCHEMA}, schema=SCHEMA)
@@ -0,0 +1,128 @@
+import gzip
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from typing import Any, Dict, Iterator, Optional, Tuple
+from proxy import WrapperProxy
+from records import ContractInfo
+from wrapper import TradeApp
+
+logger = logging.getLogger()
+
+# log records: (seconds since the start, kind, name, args)
+#   'callback': an EWrapper callback and its (positional, keyword) arguments, as received
+#   'request'/'release': a reqId registry change (TradeApp.newRequest/releaseRequest)
+#   'state': what the run computed beside the callbacks (currency rates, contract details from the cache)
+Record = Tuple[float, str, str, Any]
+
+
+class CallbackRecorder(WrapperProxy):
+    '''
+        Appends every callback of a TradeApp with its arguments to a gzipped stream of pickles before dispatching it.
+        The stream goes to a temporary file beside `filename`, renamed on close(): an attempt given up with discard(),
+        or never closed, leaves the log of another session intact.
+    '''
+    def __init__(self, wrapper: Any, filename: str) -> None:
+        super().__init__(wrapper)
+        self.filename = filename
+        fd, self.tmp = tempfile.mkstemp(prefix=f"{os.path.basename(filename)}.", suffix=".tmp", dir=os.path.dirname(filename) or ".")
+        os.close(fd)
+        self.file: Optional[gzip.GzipFile] = gzip.open(self.tmp, "wb", compresslevel=6)
+        self.lock = threading.Lock()  # callbacks come from the EReader thread, registry changes from the caller's
+        self.start = time.monotonic()
+        self.records = 0
+
+    def write(self, kind: str, name: str, args: Any) -> None:
+        with self.lock:
+            if self.file is not None:
+                pickle.dump((time.monotonic() - self.start, kind, name, args), self.file, pickle.HIGHEST_PROTOCOL)
+                self.records += 1
+
+    def hook(self, name: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> None:
+        self.write('callback', name, (args, kwargs))
+
+    def _shut(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def discard(self) -> None:
+        '''
+            Drops the log of an abandoned session (e.g. a failed connection attempt).
+        '''
+        self._shut()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+    def close(self, app: TradeApp) -> None:
+        '''
+            Appends the final rates and contract details of the app, then closes the log.
+        '''
+        with app.lock:
+            details = {line.conId: asdict(line.details) for lines in app.portfolios.values() for line in lines
+                       if line.details is not None and line.conId}
+        self.write('state', 'currency', dict(app.currency))
+        self.write('state', 'crosses', dict(app.crosses))
+        self.write('state', 'details', details)
+        self._shut()
+        os.replace(self.tmp, self.filename)
+        logger.warning(f"Recorded {self.records} records to '{self.filename}'")
+
+
+def record(app: TradeApp, filename: str) -> TradeApp:
+    '''
+        Makes the app record its session to filename; must be called before connect().
+    '''
+    app.recorder = CallbackRecorder(app.wrapper, filename)
+    app.wrapper = app.recorder
+    return app
+
+
+def records(filename: str) -> Iterator[Record]:
+    with gzip.open(filename, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def replay(filename: str) -> TradeApp:
+    '''
+        Rebuilds accounts, portfolios, orders, contracts and currencies of a recorded session offline,
+        by feeding the recorded callbacks to a TradeApp that is never connected.
+    '''
+    start = time.perf_counter()
+    app = TradeApp()
+    details: Dict[int, Dict[str, Any]] = dict()
+    count = 0
+    for _, kind, name, args in records(filename):
+        count += 1
+        if kind == 'callback':
+            positional, keywords = args
+            getattr(app, name)(*positional, **keywords)
+        elif kind == 'request':
+            reqId, purpose, payload = args
+            app.requests[reqId] = (purpose, payload)
+            app.lastReqId = max(app.lastReqId, reqId)
+        elif kind == 'release':
+            app.requests.pop(args, None)
+        elif kind == 'state' and name == 'currency':
+            app.currency = args
+        elif kind == 'state' and name == 'crosses':
+            app.crosses = args
+        elif kind == 'state' and name == 'details':
+            details = args
+    shared = {conId: ContractInfo(**info) for conId, info in details.items()}
+    for lines in app.portfolios.values():
+        for line in lines:
+            line.details = shared.get(line.conId, line.details)
+    app.takeDirty()
+    logger.warning(f"Replayed {count} records of '{filename}' in {time.perf_counter() - start:.3f}s: "
+                   f"{len(app.portfolios)} accounts, {sum(len(lines) for lines in app.portfolios.values())} lines")
+    return app
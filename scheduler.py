@@ -0,0 +1,128 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+from metrics import metrics
+
+logger = logging.getLogger()
+
+# TWS rejects clients sending more than 50 messages per second (error 100)
+LIMIT = 50.0
+RATE = float(os.getenv("IB_RATE") or 45.0)
+BURST = float(os.getenv("IB_BURST") or 5.0)  # kept so that RATE + BURST stays within LIMIT
+MAX_IN_FLIGHT = int(os.getenv("IB_MAX_INFLIGHT") or 40)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = BURST) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Take one token, sleeping until one is available.
+
+        Returns:
+            Time spent waiting, in seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1.0
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RequestScheduler:
+    '''
+        Pipelines requests to TWS: a token bucket keeps the client under the API message rate
+        and at most maxInFlight requests are waiting for their *End callback at any time.
+        Completion is tracked per key through TradeApp.startRequest/endRequest.
+    '''
+    def __init__(self, app: Any, rate: float = RATE, maxInFlight: int = MAX_IN_FLIGHT) -> None:
+        self.app = app
+        # a full bucket lets `burst` messages through on top of `rate` in the first second
+        self.bucket = TokenBucket(rate, max(1.0, min(BURST, LIMIT - rate)))
+        self.maxInFlight = maxInFlight
+        self.inflight: Set[Hashable] = set()
+        self.reset()
+
+    def reset(self) -> None:
+        self.inflight.clear()
+        self.sent = 0
+        self.rateStalls = 0
+        self.rateWait = 0.0
+        self.inflightStalls = 0
+        self.inflightWait = 0.0
+        self.started: Optional[float] = None
+
+    def submit(self, key: Hashable, send: Callable[[], None], timeout: Optional[float] = None) -> bool:
+        """
+        Send a request once the pacing rules allow it.
+
+        Args:
+            key: Completion key, released by the request's *End callback.
+            send: Function actually sending the request to TWS.
+            timeout: Maximum time to wait for an in-flight slot.
+
+        Returns:
+            False if no slot got free before the timeout, the request is then not sent.
+        """
+        with self.app.pendingCond:
+            busy = len(self.app.pending & self.inflight) >= self.maxInFlight
+        if busy:
+            self.inflightStalls += 1
+            start = time.monotonic()
+            if not self.app.waitRequests(self.inflight, timeout, atMost=self.maxInFlight - 1):
+                return False
+            self.inflightWait += time.monotonic() - start
+        wait = self.bucket.acquire()
+        if wait > 0:
+            self.rateStalls += 1
+            self.rateWait += wait
+        if self.started is None:
+            self.started = time.monotonic()
+        self.inflight.add(key)
+        self.app.startRequest(key)
+        send()
+        self.sent += 1
+        metrics.count("requests.paced")
+        return True
+
+    def pace(self, send: Callable[[], None]) -> None:
+        """Send a message without an *End callback (cancels, unsubscriptions) within the same message rate."""
+        wait = self.bucket.acquire()
+        if wait > 0:
+            self.rateStalls += 1
+            self.rateWait += wait
+        send()
+        metrics.count("requests.paced")
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the completion of every request submitted since the last reset."""
+        return self.app.waitRequests(self.inflight, timeout)
+
+    def report(self, what: str) -> Dict[str, float]:
+        """Log throughput and pacing stalls of the current phase, then reset the counters."""
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        stats = {
+            'requests': self.sent,
+            'elapsed': elapsed,
+            'throughput': self.sent / elapsed if elapsed > 0 else 0.0,
+            'rateStalls': self.rateStalls,
+            'rateWait': self.rateWait,
+            'inflightStalls': self.inflightStalls,
+            'inflightWait': self.inflightWait,
+        }
+        logger.warning(f"{what}: {self.sent} requests in {elapsed:.2f}s ({stats['throughput']:.1f} req/s), "
+                       f"{self.rateStalls} rate stalls ({self.rateWait:.2f}s), "
+                       f"{self.inflightStalls} in-flight stalls ({self.inflightWait:.2f}s)")
+        self.reset()
+        return stats
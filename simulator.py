@@ -0,0 +1,230 @@
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+from ibapi.common import TickAttrib, TickerId
+from ibapi.contract import Contract, ContractDetails
+from ibapi.order import Order
+from ibapi.order_state import OrderState
+from cachedfaz import CachedFrankfurter
+from wrapper import TradeApp
+
+logger = logging.getLogger()
+
+# units of each currency for 1 USD
+RATES = {'USD': 1.0, 'EUR': 0.92, 'CHF': 0.88, 'GBP': 0.79, 'JPY': 151.0, 'CAD': 1.36, 'SEK': 10.5, 'HKD': 7.8}
+# currencies the Frankfurter stub does not know, priced through the FAZ page stub
+NOT_ON_API = {'HKD'}
+
+
+class SimulatedTradeApp(TradeApp):
+    '''
+        A TradeApp answering its own requests with synthetic accounts, positions, orders, contract details
+        and FX quotes, without any TWS. Answers are delivered `latency` seconds after the request by one
+        dispatcher thread standing for the EReader thread, in due time order, through app.wrapper like
+        the decoder does, so that wrapper proxies see them.
+    '''
+    def __init__(self, accounts: int = 5, positions: int = 200, orders: int = 10, contracts: int = 2000,
+                 latency: float = 0.0, unpriced: Optional[Set[str]] = None, seed: int = 1) -> None:
+        '''
+            accounts, positions, orders: book size, positions and orders per account
+            contracts: size of the universe positions are drawn from, shared between accounts
+            latency: seconds between a request and each of its answers
+            unpriced: currencies TWS has no quote for, in any direction
+        '''
+        super().__init__()
+        rnd = random.Random(seed)
+        self.latency = latency
+        self.unpriced = set(unpriced or ())
+        self.universe = [self.makeContract(conId, rnd) for conId in range(1, contracts + 1)]
+        self.book: Dict[str, List[Tuple[Contract, float, float]]] = dict()  # account -> (contract, position, price)
+        self.live: Dict[str, List[Tuple[Contract, Order]]] = dict()
+        orderId = 1
+        for n in range(accounts):
+            account = f"DU{1000000 + n}"
+            held = rnd.sample(self.universe, min(positions, len(self.universe)))
+            self.book[account] = [(c, float(rnd.randint(1, 500)), round(rnd.uniform(1.0, 300.0), 2)) for c in held]
+            self.live[account] = list()
+            for c in rnd.sample(held, min(orders, len(held))):
+                o = Order()
+                o.orderId = orderId
+                o.account = account
+                o.action = rnd.choice(["BUY", "SELL"])
+                o.totalQuantity = float(rnd.randint(1, 100))
+                o.orderType = "LMT"
+                o.lmtPrice = round(rnd.uniform(1.0, 300.0), 2)
+                o.orderRef = f"sim{orderId}"
+                self.live[account].append((c, o))
+                orderId += 1
+        self.simConnected = False
+        self.due: List[Tuple[float, int, Callable[[], None]]] = list()
+        self.dueCond = threading.Condition()
+        self.seq = 0
+
+    @staticmethod
+    def makeContract(conId: int, rnd: random.Random) -> Contract:
+        c = Contract()
+        c.conId = conId
+        c.symbol = f"SIM{conId}"
+        c.localSymbol = c.symbol
+        c.secType = "STK"
+        c.primaryExchange = rnd.choice(["NYSE", "NASDAQ", "EBS", "LSE", "IBIS", "SEHK", "TSEJ", "TSE"])
+        c.currency = {"NYSE": "USD", "NASDAQ": "USD", "EBS": "CHF", "LSE": "GBP", "IBIS": "EUR",
+                      "SEHK": "HKD", "TSEJ": "JPY", "TSE": "CAD"}[c.primaryExchange]
+        return c
+
+    def answer(self, *answers: Callable[[], None]) -> None:
+        due = time.monotonic() + self.latency
+        with self.dueCond:
+            for fn in answers:
+                self.seq += 1
+                heapq.heappush(self.due, (due, self.seq, fn))
+            self.dueCond.notify_all()
+
+    def dispatch(self) -> None:
+        while True:
+            with self.dueCond:
+                while self.simConnected and (not self.due or self.due[0][0] > time.monotonic()):
+                    self.dueCond.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                if not self.simConnected:
+                    return
+                _, _, fn = heapq.heappop(self.due)
+            fn()
+
+    # EClient side
+
+    def connect(self, host: str, port: int, clientId: int) -> None:
+        self.host, self.port, self.clientId = host, port, clientId
+        self.simConnected = True
+        threading.Thread(target=self.dispatch, name="simulated EReader", daemon=True).start()
+        self.answer(lambda: self.wrapper.managedAccounts(",".join(self.book.keys())), lambda: self.wrapper.nextValidId(1))
+
+    def isConnected(self) -> bool:
+        return self.simConnected
+
+    def run(self) -> None:
+        with self.dueCond:
+            self.dueCond.wait_for(lambda: not self.simConnected)
+
+    def disconnect(self) -> None:
+        with self.dueCond:
+            self.simConnected = False
+            self.dueCond.notify_all()
+
+    def reqMarketDataType(self, marketDataType: int) -> None:
+        pass
+
+    def reqAccountSummary(self, reqId: int, groupName: str, tags: str) -> None:
+        self.answer(*[lambda account=account: self.wrapper.accountSummary(reqId, account, "AccountType", "INDIVIDUAL", "")
+                      for account in self.book], lambda: self.wrapper.accountSummaryEnd(reqId))
+
+    def cancelAccountSummary(self, reqId: int) -> None:
+        pass
+
+    def reqAccountUpdates(self, subscribe: bool, acctCode: str) -> None:
+        if not subscribe or acctCode not in self.book:
+            return
+        lines = self.book[acctCode]
+        total = sum(position * price / RATES[c.currency] for c, position, price in lines) * 1.1
+        self.answer(lambda: self.wrapper.updateAccountValue("NetLiquidation", f"{total:.2f}", "USD", acctCode),
+                    *[lambda c=c, position=position, price=price: self.wrapper.updatePortfolio(
+                        c, position, price, position * price, price * 0.9, position * price * 0.1, 0.0, acctCode)
+                      for c, position, price in lines],
+                    lambda: self.wrapper.accountDownloadEnd(acctCode))
+
+    def reqAllOpenOrders(self) -> None:
+        answers = list()
+        for account, orders in self.live.items():
+            for c, o in orders:
+                answers.append(lambda c=c, o=o: self.wrapper.openOrder(o.orderId, c, o, OrderState()))
+                answers.append(lambda o=o: self.wrapper.orderStatus(o.orderId, "Submitted", 0.0, o.totalQuantity, 0.0, o.orderId, 0, 0.0,
+                                                            self.clientId, "", 0.0))
+        self.answer(*answers, self.wrapper.openOrderEnd)
+
+    def reqMktData(self, reqId: TickerId, contract: Contract, genericTickList: str, snapshot: bool,
+                   regulatorySnapshot: bool, mktDataOptions: Any) -> None:
+        pair = {contract.symbol, contract.currency}
+        if pair & self.unpriced or not pair <= RATES.keys():
+            self.answer(lambda: self.wrapper.error(reqId, 200, "No security definition has been found for the request"))
+            return
+        price = RATES[contract.currency] / RATES[contract.symbol]
+        self.answer(lambda: self.wrapper.tickPrice(reqId, 9, price, TickAttrib()), lambda: self.wrapper.tickSnapshotEnd(reqId))
+
+    def cancelMktData(self, reqId: TickerId) -> None:
+        pass
+
+    def reqContractDetails(self, reqId: int, contract: Contract) -> None:
+        cd = ContractDetails()
+        cd.contract = contract
+        cd.longName = f"Simulated {contract.symbol} Inc."
+        cd.stockType = "COMMON"
+        cd.industry = "Technology"
+        cd.category = "Software"
+        cd.subcategory = "Simulation"
+        cd.minTick = 0.01
+        self.answer(lambda: self.wrapper.contractDetails(reqId, cd), lambda: self.wrapper.contractDetailsEnd(reqId))
+
+
+
+class StubFxServer:
+    '''
+        Local HTTP server standing for frankfurter.app (/latest?from=XXX) and the FAZ converter page (/snippet.htn),
+        both derived from RATES, answering after `latency` seconds.
+    '''
+    def __init__(self, latency: float = 0.0, rates: Optional[Dict[str, float]] = None) -> None:
+        self.latency = latency
+        self.rates = rates or RATES
+        self.requests = 0
+        codes = {number: cur for cur, number in CachedFrankfurter.iso4217.items()}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                stub.requests += 1
+                time.sleep(stub.latency)
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == "/latest":
+                    base = query.get("from", "EUR")
+                    if base not in stub.rates or base in NOT_ON_API:
+                        return self.reply(404, "application/json", json.dumps({"message": "not found"}))
+                    table = {cur: rate / stub.rates[base] for cur, rate in stub.rates.items() if cur != base and cur not in NOT_ON_API}
+                    return self.reply(200, "application/json", json.dumps({"amount": 1.0, "base": base, "date": "2026-01-02", "rates": table}))
+                if url.path == "/snippet.htn":
+                    what, inwhat = codes.get(int(query.get("swaehrung", 0))), codes.get(int(query.get("zwaehrung", 0)))
+                    if what not in stub.rates or inwhat not in stub.rates:
+                        return self.reply(404, "text/html", "<html></html>")
+                    amount = float(query.get("betrag", 1)) * stub.rates[inwhat] / stub.rates[what]
+                    text = f"{amount:,.4f}".replace(",", " ").replace(".", ",").replace(" ", ".")  # German number format
+                    return self.reply(200, "text/html", f'<html><body><span class="bigone">{text} {inwhat}</span></body></html>')
+                self.reply(404, "text/plain", "")
+
+            def reply(self, status: int, contentType: str, body: str) -> None:
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="stub fx server", daemon=True).start()
+
+    def frankfurter(self, file: str) -> CachedFrankfurter:
+        '''
+            A CachedFrankfurter pointed at this server, without retries.
+        '''
+        return CachedFrankfurter(file, api_url=f"{self.url}/latest", www_url=f"{self.url}/snippet.htn", retries=0)
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
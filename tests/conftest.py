@@ -0,0 +1,70 @@
+import os
+import sys
+from typing import Callable, Iterator, List
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+from cachedcontracts import CachedContracts  # noqa: E402
+from scheduler import RequestScheduler  # noqa: E402
+from simulator import SimulatedTradeApp, StubFxServer  # noqa: E402
+from utils import ibConnect, getAccounts, getOpenOrders, getCurrencies, getAssetDetails  # noqa: E402
+
+BaseCur = ['USD', 'CHF', 'EUR']
+
+
+@pytest.fixture(scope="session")
+def stub() -> Iterator[StubFxServer]:
+    server = StubFxServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def caches(tmp_path, stub: StubFxServer) -> Iterator[str]:
+    '''
+        Empty FX and contract caches in a temporary directory, installed as the utils ones.
+    '''
+    utils.forex_api = stub.frankfurter(str(tmp_path / "fx.bin"))
+    utils.contract_db = CachedContracts(str(tmp_path / "contracts.bin"))
+    yield str(tmp_path)
+    utils.forex_api.close()
+    utils.contract_db.close()
+    utils.forex_api = utils.contract_db = None
+
+
+@pytest.fixture
+def simulated(caches: str) -> Iterator[Callable[..., SimulatedTradeApp]]:
+    '''
+        Connects SimulatedTradeApps, unpaced; wrap(app) can interpose a proxy (e.g. replay.record) before connect.
+        Every app is disconnected at teardown.
+    '''
+    apps: List[SimulatedTradeApp] = list()
+
+    def connect(accounts: int = 3, positions: int = 40, orders: int = 4, contracts: int = 200, latency: float = 0.0,
+                unpriced=("HKD", "SEK"), wrap=lambda app: app) -> SimulatedTradeApp:
+        def factory() -> SimulatedTradeApp:
+            app = SimulatedTradeApp(accounts, positions, orders, contracts, latency, set(unpriced))
+            app.scheduler = RequestScheduler(app, rate=100000.0)
+            return wrap(app)
+        app = ibConnect("simulator", factory=factory, retries=0)
+        assert app is not None
+        apps.append(app)
+        return app
+
+    yield connect
+    for app in apps:
+        app.disconnect()
+
+
+def download(app: SimulatedTradeApp) -> SimulatedTradeApp:
+    '''
+        Every download phase of ib2csv.py, in order.
+    '''
+    getAccounts(app)
+    getOpenOrders(app)
+    getCurrencies(app, BaseCur)
+    getAssetDetails(app)
+    return app
@@ -0,0 +1,91 @@
+'''
+    pytest-benchmark cases for each phase of the export and for the whole flow, against the simulated TWS and the stub
+    FX server, unpaced (the client alone):
+
+        python -m pytest tests/test_benchmark.py --benchmark-only
+'''
+import os
+from typing import Any, Dict, Tuple
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import utils  # noqa: E402
+from cachedcontracts import CachedContracts  # noqa: E402
+from conftest import BaseCur, download  # noqa: E402
+from output import writeAccount  # noqa: E402
+from utils import computeThings, getAccounts, getAssetDetails, getCurrencies, getOpenOrders  # noqa: E402
+
+SIZE = dict(accounts=5, positions=200, orders=10, contracts=2000)
+ROUNDS = 5
+
+
+@pytest.fixture
+def fresh(simulated, tmp_path):
+    '''
+        Setup function of benchmark.pedantic: a new connected app with the previous phases done, and an empty contract cache.
+    '''
+    rounds = iter(range(1000))
+
+    def setup(*phases) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
+        utils.contract_db.close()
+        utils.contract_db = CachedContracts(str(tmp_path / f"contracts{next(rounds)}.bin"))
+        app = simulated(**SIZE)
+        for phase in phases:
+            phase(app)
+        return (app,), {}
+    return setup
+
+
+def test_connect(benchmark, simulated) -> None:
+    benchmark.pedantic(simulated, kwargs=SIZE, rounds=ROUNDS)
+
+
+def test_accounts(benchmark, fresh) -> None:
+    benchmark.pedantic(getAccounts, setup=lambda: fresh(), rounds=ROUNDS)
+
+
+def test_orders(benchmark, fresh) -> None:
+    benchmark.pedantic(getOpenOrders, setup=lambda: fresh(getAccounts), rounds=ROUNDS)
+
+
+def test_fx(benchmark, fresh) -> None:
+    '''
+        TWS quotes, then the web fallback for HKD and SEK (from the FX cache after the first round).
+    '''
+    benchmark.pedantic(lambda app: getCurrencies(app, BaseCur), setup=lambda: fresh(getAccounts, getOpenOrders), rounds=ROUNDS)
+
+
+def test_contracts(benchmark, fresh) -> None:
+    benchmark.pedantic(getAssetDetails, setup=lambda: fresh(getAccounts, getOpenOrders, lambda app: getCurrencies(app, BaseCur)),
+                       rounds=ROUNDS)
+
+
+def test_compute(benchmark, simulated) -> None:
+    app = download(simulated(**SIZE))
+    frames = benchmark(computeThings, app, BaseCur)
+    assert len(frames) == SIZE['accounts']
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet", "ipc"])
+def test_write(benchmark, simulated, tmp_path, fmt: str) -> None:
+    frames = computeThings(download(simulated(**SIZE)), BaseCur)
+
+    def write() -> None:
+        for account, df in frames.items():
+            writeAccount(df, str(tmp_path / account), fmt)
+    benchmark(write)
+    assert len(os.listdir(tmp_path)) >= SIZE['accounts']
+
+
+def test_end_to_end(benchmark, simulated, tmp_path) -> None:
+    '''
+        What ib2csv.py does: connect, download every phase, disconnect, compute and write one CSV file per account.
+    '''
+    def export() -> None:
+        app = download(simulated(**SIZE))
+        app.disconnect()
+        for account, df in computeThings(app, BaseCur).items():
+            writeAccount(df, str(tmp_path / account), "csv")
+    benchmark.pedantic(export, rounds=ROUNDS)
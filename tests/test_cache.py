@@ -0,0 +1,161 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import cachedApi
+from cachedApi import CachedApi
+from cachedcontracts import CachedContracts
+from records import ContractInfo
+
+
+class Clock:
+    def __init__(self, now: float = 1_000_000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cachedApi, "time", clock)
+    return clock
+
+
+def opened(cache: CachedApi) -> CachedApi:
+    cache.open_db()
+    return cache
+
+
+def revalidated() -> None:
+    for thread in threading.enumerate():
+        if thread.name.startswith("revalidate "):
+            thread.join(5)
+
+
+def test_expiry(tmp_path, clock: Clock) -> None:
+    cache = opened(CachedApi(str(tmp_path / "c.bin")))
+    cache.cache_set("k", 10, "v")
+    clock.now += 9
+    assert cache.cache_get("k", 10) == "v"
+    clock.now += 2
+    assert cache.cache_get("k", 10) is None
+    assert cache.cache_get("unknown", 10) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.close()
+
+
+def test_persisted_across_instances(tmp_path, clock: Clock) -> None:
+    details = ContractInfo(longName="Apple", industry="Technology", priceMagnifier=1, minTick=0.01)
+    contracts = CachedContracts(str(tmp_path / "contracts.bin"), ttl=3600)
+    contracts.set(265598, details)
+    contracts.close()
+    contracts = CachedContracts(str(tmp_path / "contracts.bin"), ttl=3600)
+    assert contracts.get(265598) == details
+    clock.now += 3601
+    assert contracts.get(265598) is None
+    contracts.close()
+
+
+def test_stale_while_revalidate(tmp_path, clock: Clock) -> None:
+    cache = opened(CachedApi(str(tmp_path / "c.bin"), stale=100))
+    fetched = threading.Event()
+    calls = []
+
+    def fetch() -> str:
+        calls.append(clock.now)
+        fetched.set()
+        return f"v{len(calls)}"
+
+    assert cache.cache_fetch("k", 10, fetch) == "v1"  # miss: fetched by the caller
+    clock.now += 5
+    assert cache.cache_fetch("k", 10, fetch) == "v1"  # fresh
+    assert len(calls) == 1
+
+    clock.now += 20  # expired for 15 s, within `stale`
+    fetched.clear()
+    assert cache.cache_fetch("k", 10, fetch) == "v1"  # served at once, refreshed in background
+    assert fetched.wait(5)
+    revalidated()
+    assert cache.cache_fetch("k", 10, fetch) == "v2"
+    assert cache.stale_hits == 1 and len(calls) == 2
+
+    clock.now += 500  # beyond `stale`: the caller waits for the fetch
+    assert cache.cache_fetch("k", 10, fetch) == "v3"
+    cache.close()
+
+
+def test_failed_revalidation_keeps_the_stale_value(tmp_path, clock: Clock) -> None:
+    cache = opened(CachedApi(str(tmp_path / "c.bin"), stale=100))
+    cache.cache_set("k", 10, "old")
+    clock.now += 20
+    failed = threading.Event()
+
+    def fetch() -> str:
+        failed.set()
+        raise ConnectionError("down")
+
+    assert cache.cache_fetch("k", 10, fetch) == "old"
+    assert failed.wait(5)
+    revalidated()
+    assert cache.cache_get("k", 10) is None  # still expired
+    assert cache.cache_fetch("k", 10, lambda: "new") == "old"  # and still served while stale
+    revalidated()
+    assert cache.cache_get("k", 10) == "new"
+    cache.close()
+
+
+def test_writes_committed_without_a_later_write(tmp_path) -> None:
+    cache = opened(CachedApi(str(tmp_path / "c.bin"), commit_interval=0.1))
+    cache.cache_set("k", 10, "v")
+    other = sqlite3.connect(str(tmp_path / "c.bin"))
+    for _ in range(50):
+        if other.execute("SELECT COUNT(*) FROM cache").fetchone()[0]:
+            break
+        time.sleep(0.02)
+    assert other.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 1
+    other.execute("BEGIN IMMEDIATE")  # the write lock is free again
+    other.rollback()
+    other.close()
+    cache.close()
+
+
+def test_locked_database_is_skipped(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(cachedApi, "BUSY_TIMEOUT", 50)
+    cache = opened(CachedApi(str(tmp_path / "c.bin")))
+    other = sqlite3.connect(str(tmp_path / "c.bin"))
+    other.execute("BEGIN IMMEDIATE")  # another process holding the write lock
+    cache.cache_set("k", 10, "v")
+    assert cache.cache_get("k", 10) == "v"  # kept in memory
+    assert cache.writes == 0
+    other.rollback()
+    other.close()
+    cache.close()
+
+
+def test_opens_next_to_a_writer(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(cachedApi, "BUSY_TIMEOUT", 50)
+    legacy = sqlite3.connect(str(tmp_path / "c.bin"))
+    legacy.execute("CREATE TABLE unnamed (key TEXT PRIMARY KEY, value BLOB)")
+    legacy.commit()
+    legacy.execute("BEGIN IMMEDIATE")  # another process writing
+    cache = opened(CachedApi(str(tmp_path / "c.bin")))  # cannot even create its table: memory only
+    cache.cache_set("k", 10, "v")
+    assert cache.cache_get("k", 10) == "v"
+    legacy.rollback()
+    legacy.close()
+    cache.close()
+    cache = opened(CachedApi(str(tmp_path / "c.bin")))
+    other = sqlite3.connect(str(tmp_path / "c.bin"))
+    assert other.execute("SELECT name FROM sqlite_master WHERE name = 'unnamed'").fetchone() is None
+    other.execute("BEGIN IMMEDIATE")  # writing again, the cache table exists now
+    cache.close()
+    cache = opened(CachedApi(str(tmp_path / "c.bin")))
+    cache.cache_set("k", 10, "v")  # skipped
+    assert cache.cache_get("k", 10) == "v"
+    other.rollback()
+    other.close()
+    cache.close()
@@ -0,0 +1,46 @@
+import threading
+import time
+
+from conftest import BaseCur, download
+from daemon import refreshOpenOrders, runDaemon
+
+
+def test_refresh_marks_only_changed_orders(simulated) -> None:
+    app = download(simulated(accounts=2, positions=10, orders=3))
+    app.takeDirty()
+    assert refreshOpenOrders(app) == set()
+    assert app.takeDirty() == set()
+
+    first, second = list(app.live)
+    app.live[first].pop()  # an order filled or cancelled
+    assert refreshOpenOrders(app) == {first}
+    assert app.takeDirty() == {first}
+    assert sum(1 for line in app.portfolios[first] if line.orderId is not None) == 2
+    assert sum(1 for line in app.portfolios[second] if line.orderId is not None) == 3
+
+
+def test_resent_account_updates_are_not_changes(simulated) -> None:
+    '''
+        Every refresh moves the subscription to the next account, which TWS replays in full.
+    '''
+    app = download(simulated(accounts=3, positions=10, orders=1))
+    published = []
+    stop = threading.Event()
+    daemon = threading.Thread(target=runDaemon, args=(app, BaseCur, lambda frames: published.append(sorted(frames))),
+                              kwargs=dict(interval=0.1, stop=stop))
+    daemon.start()
+    try:
+        time.sleep(1.0)  # about three rotations
+        assert published == [sorted(app.portfolios)]  # the download itself, once
+
+        account = list(app.book)[1]
+        c, position, price = app.book[account][0]
+        app.book[account][0] = (c, position + 1, price)
+        for _ in range(50):
+            if len(published) > 1:
+                break
+            time.sleep(0.05)
+        assert published[1:] == [[account]]
+    finally:
+        stop.set()
+        daemon.join(5)
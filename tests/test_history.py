@@ -0,0 +1,62 @@
+import pytest
+
+from conftest import download
+from history import SnapshotStore, appRows
+
+
+def position(quantity: float, value: float) -> dict:
+    return {'symbol': "AAPL", 'position': quantity, 'marketValue': value}
+
+
+@pytest.fixture
+def store(tmp_path) -> SnapshotStore:
+    '''
+        t=100: AAPL 10, EUR 0.92; t=200: AAPL 12, MSFT added; t=300: AAPL sold, EUR 0.93.
+    '''
+    store = SnapshotStore(str(tmp_path / "history.db"))
+    store.record({('position', "DU1", "1"): position(10, 1000.0), ('fx', "", "EUR"): {'rate': 0.92}}, ts=100)
+    store.record({('position', "DU1", "1"): position(12, 1200.0), ('position', "DU1", "2"): position(5, 2000.0),
+                  ('fx', "", "EUR"): {'rate': 0.92}}, ts=200)
+    store.record({('position', "DU1", "2"): position(5, 2000.0), ('fx', "", "EUR"): {'rate': 0.93}}, ts=300)
+    yield store
+    store.close()
+
+
+def test_rebuild_any_point_in_time(store: SnapshotStore) -> None:
+    assert [ts for _, ts in store.snapshots()] == [100, 200, 300]
+    assert store.snapshot(at=50) == {}
+
+    first = store.snapshot(at=150)
+    assert first['position'].select('key', 'position').rows() == [("1", 10)]
+    assert first['fx']['rate'].to_list() == [0.92]
+
+    second = store.snapshot(at=250)
+    assert sorted(second['position'].select('key', 'position').rows()) == [("1", 12), ("2", 5)]
+
+    latest = store.snapshot()
+    assert latest['position'].select('key', 'position').rows() == [("2", 5)]
+    assert latest['fx']['rate'].to_list() == [0.93]
+
+
+def test_only_changes_are_stored(store: SnapshotStore) -> None:
+    assert store.series('fx', "", "EUR")['rate'].to_list() == [0.92, 0.93]  # unchanged at t=200
+    assert store.series('position', "DU1", "2")['ts'].to_list() == [200]
+
+
+def test_series_shows_removal(store: SnapshotStore) -> None:
+    series = store.series('position', "DU1", "1")
+    assert series['ts'].to_list() == [100, 200, 300]
+    assert series['position'].to_list() == [10, 12, None]
+    assert store.series('position', "DU1", "nothing").is_empty()
+
+
+def test_records_a_download(simulated, tmp_path) -> None:
+    app = download(simulated(accounts=2, positions=10, orders=2))
+    store = SnapshotStore(str(tmp_path / "history.db"))
+    store.record(appRows(app), ts=1)
+    store.record(appRows(app), ts=2)
+    state = store.snapshot()
+    assert len(state['position']) == 20 and len(state['order']) == 4
+    assert set(state['fx']['key']) == set(app.currency)
+    assert store.series('fx', "", "JPY")['ts'].to_list() == [1]  # second run unchanged
+    store.close()
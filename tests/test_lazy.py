@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# fresh interpreter: the first use of polars must happen in the threads
+FIRST_USE = '''
+import sys, threading
+from lazy import lazyImport
+pl = lazyImport("polars")
+assert "polars" not in sys.modules
+start, failures = threading.Barrier(8), []
+def use():
+    start.wait()
+    try:
+        pl.DataFrame({"a": [1]}).select(pl.col("a") * 2)
+    except Exception as ee:
+        failures.append(repr(ee))
+threads = [threading.Thread(target=use) for _ in range(8)]
+[thread.start() for thread in threads]
+[thread.join() for thread in threads]
+print(failures)
+'''
+
+
+def test_first_use_from_several_threads() -> None:
+    for _ in range(3):
+        probe = subprocess.run([sys.executable, "-c", FIRST_USE], cwd=ROOT, capture_output=True, text=True, check=True)
+        assert probe.stdout.strip() == "[]"
+
+
+def test_pipeline_modules_import_nothing_heavy() -> None:
+    probe = subprocess.run([sys.executable, "-c", "import sys, utils, output, records, history, daemon, gateways, replay; "
+                            "print(sorted({'polars', 'requests', 'lxml'} & sys.modules.keys()))"],
+                           cwd=ROOT, capture_output=True, text=True, check=True)
+    assert probe.stdout.strip() == "[]"
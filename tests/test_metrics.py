@@ -0,0 +1,31 @@
+from metrics import Metrics, prometheus
+
+
+def test_prometheus_exact_values_and_units() -> None:
+    report = {'duration_seconds': 1.5, 'phases': {'fx': {'wall_seconds': 0.123456789, 'cpu_seconds': 0.01, 'calls': 1}},
+              'counters': {'output.bytes': 12345678, 'output.files': 3, 'requests.paced': 1234567,
+                           'cache_fx.hits': 4, 'cache_fx.get_seconds': 0.000123456789, 'http_seconds.faz': 0.5}}
+    lines = prometheus(report).splitlines()
+    assert 'ib2csv_phase_wall_seconds{phase="fx"} 0.123456789' in lines
+    assert "ib2csv_output_bytes 12345678" in lines
+    assert 'ib2csv_output_total{name="files"} 3' in lines
+    assert 'ib2csv_requests_total{name="paced"} 1234567' in lines
+    assert 'ib2csv_cache_fx_total{name="hits"} 4' in lines
+    assert "ib2csv_cache_fx_get_seconds 0.000123456789" in lines
+    assert 'ib2csv_http_seconds{name="faz"} 0.5' in lines
+    assert sum(1 for line in lines if line.startswith("# TYPE ib2csv_cache_fx")) == 2
+
+
+def test_phases_and_counters() -> None:
+    metrics = Metrics()
+    with metrics.phase("fx"):
+        pass
+    metrics.timed("fx")(lambda: None)()
+    metrics.count("output.files")
+    metrics.count("output.files", 2)
+    metrics.register(lambda: {'cache_fx.hits': 5})
+    report = metrics.report()
+    assert report['phases']['fx']['calls'] == 2
+    assert report['counters'] == {'cache_fx.hits': 5, 'output.files': 3}
+    metrics.reset()
+    assert metrics.report()['counters'] == {'cache_fx.hits': 5}
@@ -0,0 +1,50 @@
+import gc
+import os
+
+from conftest import BaseCur, download
+from replay import record, records, replay
+from utils import computeThings
+from wrapper import TradeApp
+
+
+def test_replay_rebuilds_the_same_frames(simulated, tmp_path) -> None:
+    session = str(tmp_path / "session.gz")
+    app = download(simulated(accounts=3, positions=25, orders=3, wrap=lambda app: record(app, session)))
+    app.recorder.close(app)
+    live = computeThings(app, BaseCur)
+
+    replayed = replay(session)
+    assert replayed.currency == app.currency
+    assert replayed.crosses == app.crosses
+    assert replayed.requests == app.requests  # every request released in both
+    frames = computeThings(replayed, BaseCur)
+    assert list(frames) == list(live)
+    for account, df in live.items():
+        assert frames[account].equals(df), account
+
+
+def test_session_log(simulated, tmp_path) -> None:
+    session = str(tmp_path / "session.gz")
+    app = download(simulated(accounts=1, positions=5, orders=1, wrap=lambda app: record(app, session)))
+    app.recorder.close(app)
+    kinds = [(kind, name) for _, kind, name, _ in records(session)]
+    assert kinds[-3:] == [('state', 'currency'), ('state', 'crosses'), ('state', 'details')]
+    assert ('callback', 'managedAccounts') in kinds and ('callback', 'updatePortfolio') in kinds
+    requested = [kind for kind, _ in kinds if kind == 'request']
+    assert requested and len(requested) == sum(1 for kind, _ in kinds if kind == 'release')
+    stamps = [at for at, _, _, _ in records(session)]
+    assert stamps == sorted(stamps)
+
+
+def test_abandoned_recorder_keeps_the_log(simulated, tmp_path) -> None:
+    (tmp_path / "logs").mkdir()
+    session = str(tmp_path / "logs" / "session.gz")
+    failed = record(TradeApp(), session)  # a connection attempt given up, as in utils.ibConnect
+    failed.recorder.hook('managedAccounts', ("DU0",), {})
+    app = download(simulated(accounts=1, positions=5, orders=1, wrap=lambda app: record(app, session)))
+    failed.recorder.discard()
+    app.recorder.close(app)
+    del failed
+    gc.collect()
+    assert os.listdir(tmp_path / "logs") == ["session.gz"]
+    assert replay(session).portfolios.keys() == app.portfolios.keys()
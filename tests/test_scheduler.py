@@ -0,0 +1,18 @@
+from scheduler import LIMIT, RATE, RequestScheduler
+from wrapper import TradeApp
+
+
+def test_first_second_within_the_tws_limit() -> None:
+    bucket = RequestScheduler(TradeApp()).bucket
+    assert bucket.rate == RATE
+    assert bucket.rate + bucket.burst <= LIMIT
+
+
+def test_paced_requests_complete(simulated) -> None:
+    app = simulated(accounts=1, positions=5)
+    app.scheduler = RequestScheduler(app, rate=1000.0, maxInFlight=2)
+    for n in range(10):
+        reqId = app.newRequest("accountSummary")
+        assert app.scheduler.submit(reqId, lambda reqId=reqId: app.reqAccountSummary(reqId, "All", "AccountType"), 5)
+    assert app.scheduler.drain(5)
+    assert app.scheduler.report("test")['requests'] == 10
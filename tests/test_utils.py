@@ -0,0 +1,98 @@
+import pytest
+from ibapi.contract import Contract
+from ibapi.order import Order
+from ibapi.order_state import OrderState
+
+from conftest import BaseCur, download
+from simulator import RATES
+from utils import computeThings, fxMatrix, getAccounts, iterAssetDetails
+from wrapper import TradeApp
+
+
+def contract(conId: int, symbol: str, currency: str, secType: str = "STK") -> Contract:
+    c = Contract()
+    c.conId, c.symbol, c.localSymbol, c.currency, c.secType = conId, symbol, symbol, currency, secType
+    c.primaryExchange = "SMART"
+    return c
+
+
+@pytest.fixture
+def book() -> TradeApp:
+    '''
+        One account worth 3000 USD: 1000 USD of AAPL, 920 EUR (1000 USD) of SAP, a buy order of 500 EUR and 1000 USD of cash.
+    '''
+    app = TradeApp()
+    app.updateAccountValue("NetLiquidation", "3000", "USD", "DU1")
+    app.updatePortfolio(contract(1, "AAPL", "USD"), 10, 100.0, 1000.0, 90.0, 100.0, 0.0, "DU1")
+    app.updatePortfolio(contract(2, "SAP", "EUR"), 5, 184.0, 920.0, 150.0, 170.0, 0.0, "DU1")
+    order = Order()
+    order.orderId, order.account, order.action, order.totalQuantity, order.lmtPrice = 7, "DU1", "BUY", 2.0, 250.0
+    app.openOrder(7, contract(2, "SAP", "EUR"), order, OrderState())
+    app.orderStatus(7, "Submitted", 0.0, 2.0, 0.0, 7, 0, 0.0, 1, "", 0.0)
+    app.currency = {'USD': 1.0, 'EUR': 0.92, 'CHF': 0.88}
+    return app
+
+
+def test_compute_converts_and_weighs(book: TradeApp) -> None:
+    df = computeThings(book, BaseCur)["DU1"]
+    rows = {(row['secType'], row['symbol'], row['orderAct']): row for row in df.iter_rows(named=True)}
+    assert len(rows) == 5
+
+    aapl, sap = rows[("STK", "AAPL", "")], rows[("STK", "SAP", "")]
+    assert aapl['marketValue.USD'] == pytest.approx(1000.0)
+    assert aapl['marketValue.CHF'] == pytest.approx(880.0)
+    assert aapl['marketValue.EUR'] == pytest.approx(920.0)
+    assert sap['marketValue.USD'] == pytest.approx(1000.0)
+    assert sap['marketValue.CHF'] == pytest.approx(880.0)
+    assert sap['marketPrice.USD'] == pytest.approx(200.0)
+    assert aapl['pct'] == pytest.approx(100.0 / 3) and sap['pct'] == pytest.approx(100.0 / 3)
+
+    order = rows[("STK", "SAP", "BUY")]
+    assert order['orderVal.EUR'] == pytest.approx(500.0)
+    assert order['orderVal.USD'] == pytest.approx(500.0 / 0.92)
+    assert order['pct'] is None
+
+    total, cash = rows[("TOTAL", None, "")], rows[("CASH", None, "")]
+    assert total['marketValue.USD'] == pytest.approx(3000.0) and total['pct'] is None
+    assert cash['marketValue.USD'] == pytest.approx(1000.0)
+    assert cash['marketValue.CHF'] == pytest.approx(880.0)
+    assert cash['pct'] == pytest.approx(100.0 / 3)
+
+
+def test_compute_leaves_unknown_currencies_null(book: TradeApp) -> None:
+    book.updatePortfolio(contract(3, "TOYOTA", "JPY"), 100, 3000.0, 300000.0, 2500.0, 50000.0, 0.0, "DU1")
+    book.currency['JPY'] = -1
+    df = computeThings(book, BaseCur)["DU1"]
+    toyota = df.filter(df['symbol'] == "TOYOTA").row(0, named=True)
+    assert toyota['marketValue.USD'] is None and toyota['pct'] is None
+    assert df.filter(df['secType'] == "STK")['marketValue.USD'].drop_nulls().len() == 2
+
+
+def test_fx_matrix() -> None:
+    fx = fxMatrix({'USD': 1.0, 'EUR': 0.92, 'CHF': 0.88, 'HKD': -1}, BaseCur)
+    rows = {row['currency']: row for row in fx.iter_rows(named=True)}
+    assert rows['EUR']['fx.USD'] == pytest.approx(1 / 0.92)
+    assert rows['EUR']['fx.CHF'] == pytest.approx(0.88 / 0.92)
+    assert rows['USD']['fx.EUR'] == pytest.approx(0.92)
+    assert not rows['HKD']['valid'] and rows['HKD']['fx.USD'] is None
+
+
+def test_currencies_from_tws_crosses_and_web(simulated) -> None:
+    '''
+        TWS quotes neither HKD nor SEK: SEK comes from the Frankfurter stub, HKD from the FAZ page stub.
+    '''
+    app = download(simulated())
+    for cur, rate in app.currency.items():
+        assert rate == pytest.approx(RATES[cur], rel=1e-6), cur
+    assert not app.requests  # every fx and contract request released
+
+
+def test_asset_details_stream_in_order(simulated) -> None:
+    app = simulated(accounts=4, positions=30, latency=0.002)
+    getAccounts(app)
+    assert list(iterAssetDetails(app)) == list(app.portfolios.keys())
+    assert all(line.details is not None for lines in app.portfolios.values() for line in lines)
+    shared = {}
+    for lines in app.portfolios.values():
+        for line in lines:
+            assert shared.setdefault(line.conId, line.details) is line.details  # one ContractInfo per contract
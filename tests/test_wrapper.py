@@ -0,0 +1,56 @@
+import pytest
+from ibapi.common import TickAttrib
+
+from wrapper import TradeApp
+
+CLOSE = 9
+
+
+@pytest.fixture
+def app() -> TradeApp:
+    app = TradeApp()
+    app.currency = {'USD': 1.0, 'JPY': -1, 'GBP': -1, 'SEK': -1}
+    return app
+
+
+def test_direct_quote(app: TradeApp) -> None:
+    reqId = app.newRequest("fx", ('JPY', 'USD', False))
+    app.tickPrice(reqId, CLOSE, 151.0, TickAttrib())
+    assert app.currency['JPY'] == 151.0
+
+
+def test_inverse_quote(app: TradeApp) -> None:
+    reqId = app.newRequest("fx", ('GBP', 'USD', True))  # GBP.USD quoted, USD.GBP wanted
+    app.tickPrice(reqId, CLOSE, 1.25, TickAttrib())
+    assert app.currency['GBP'] == pytest.approx(0.8)
+
+
+def test_cross_quote_kept_apart(app: TradeApp) -> None:
+    reqId = app.newRequest("fx", ('SEK', 'EUR', False))
+    app.tickPrice(reqId, CLOSE, 11.4, TickAttrib())
+    assert app.crosses[('SEK', 'EUR')] == 11.4
+    assert app.currency['SEK'] == -1
+
+
+def test_ids_survive_new_currencies(app: TradeApp) -> None:
+    '''
+        Ids are not positions in app.currency: a currency added between request and answer changes nothing.
+    '''
+    jpy = app.newRequest("fx", ('JPY', 'USD', False))
+    app.currency = {'AUD': -1, **app.currency}
+    gbp = app.newRequest("fx", ('GBP', 'USD', False))
+    app.tickPrice(gbp, CLOSE, 0.79, TickAttrib())
+    app.tickPrice(jpy, CLOSE, 151.0, TickAttrib())
+    assert (app.currency['JPY'], app.currency['GBP'], app.currency['AUD']) == (151.0, 0.79, -1)
+
+
+def test_unknown_released_and_other_ticks_ignored(app: TradeApp) -> None:
+    reqId = app.newRequest("fx", ('JPY', 'USD', False))
+    app.tickPrice(reqId, 1, 150.0, TickAttrib())  # bid, not the close
+    app.releaseRequest(reqId)
+    app.tickPrice(reqId, CLOSE, 152.0, TickAttrib())  # late answer of a released request
+    app.tickPrice(99999, CLOSE, 1.0, TickAttrib())
+    contract = app.newRequest("contractDetails", 42)
+    app.tickPrice(contract, CLOSE, 1.0, TickAttrib())  # not an fx request
+    assert app.currency == {'USD': 1.0, 'JPY': -1, 'GBP': -1, 'SEK': -1}
+    assert list(app.requests) == [contract]
@@ -1,85 +1,199 @@
+from __future__ import annotations
 import sys
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from wrapper import TradeApp
 import threading
 import time
 from ibapi.contract import Contract
-from typing import Dict, List, Optional, Any 
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Any 
 import os
-from cachedfaz import CachedFrankfurter
+from lazy import lazyImport
+from cachedcontracts import CachedContracts
+from metrics import metrics
+from records import ContractInfo, PortfolioLine, CONVERTED, outputSchema, toFrame
+
+pl = lazyImport("polars")
+if TYPE_CHECKING:
+    from cachedfaz import CachedFrankfurter
 
 
 basedir = os.getenv("GT_DG_DIRECTORY") or "."
-forex_api = CachedFrankfurter(os.path.join(basedir, "cacheFrankfurter.bin"))    
+TIMEOUT = float(os.getenv("IB_TIMEOUT") or 60.0)  # overall time budget of each download phase, in seconds
+FX_TIMEOUT = float(os.getenv("FX_TIMEOUT") or 15.0)  # deadline of the web fallbacks for currencies TWS did not price
+LOG_LEVEL = os.getenv("IB_LOG_LEVEL") or "WARNING"
+LOG_QUEUE = (os.getenv("IB_LOG_QUEUE") or "") not in ("", "0")
+TRIANGULATE = ['EUR', 'CHF']  # crosses tried when TWS has no USD quote for a currency
+PORT = int(os.getenv("IB_PORT") or 7496)  # 7497 for paper trading, 4001/4002 for IB Gateway
+CLIENT_ID = int(os.environ["IB_CLIENT_ID"]) if os.getenv("IB_CLIENT_ID") else None
+CONNECT_TIMEOUT = float(os.getenv("IB_CONNECT_TIMEOUT") or 5.0)  # per attempt, for nextValidId and managedAccounts
+CONNECT_RETRIES = int(os.getenv("IB_CONNECT_RETRIES") or 2)
+# caches opened on first use (forexApi, contractDb): a run TWS fully prices never opens the FX one,
+# nor imports requests and lxml
+forex_api: Optional[CachedFrankfurter] = None
+contract_db: Optional[CachedContracts] = None
+caches_lock = threading.Lock()
+
+
+def forexApi() -> CachedFrankfurter:
+    global forex_api
+    with caches_lock:
+        if forex_api is None:
+            from cachedfaz import CachedFrankfurter
+            forex_api = CachedFrankfurter(os.path.join(basedir, "cacheFrankfurter.bin"))
+        return forex_api
+
+
+def contractDb() -> CachedContracts:
+    global contract_db
+    with caches_lock:
+        if contract_db is None:
+            contract_db = CachedContracts(os.path.join(basedir, "cacheContracts.bin"))
+        return contract_db
+
+
+def httpStats() -> Dict[str, float]:
+    '''
+        Calls and seconds spent on the Frankfurter API and on the FAZ page.
+    '''
+    if forex_api is None:
+        return dict()
+    with forex_api.latencies_lock:
+        latencies = list(forex_api.latencies)
+    stats: Dict[str, float] = dict()
+    for url, seconds in latencies:
+        site = "frankfurter" if url == forex_api.api_url else "faz"
+        stats[f"http.{site}"] = stats.get(f"http.{site}", 0) + 1
+        stats[f"http_seconds.{site}"] = stats.get(f"http_seconds.{site}", 0.0) + seconds
+    return stats
+
+
+metrics.register(lambda: {f"cache_fx.{k}": v for k, v in forex_api.stats().items()} if forex_api is not None else {})
+metrics.register(lambda: {f"cache_contracts.{k}": v for k, v in contract_db.stats().items()} if contract_db is not None else {})
+metrics.register(httpStats)
 
 logger = logging.getLogger()
 
 
-def SetupLogger() -> logging.Logger:
-    logging.basicConfig(handlers=[logging.StreamHandler(sys.stdout)],
-                        level=logging.DEBUG,
-                        format="%(asctime)s - %(name)s:%(filename)s:%(funcName)s:%(lineno)d - %(levelname)s - %(message)s",
-                        datefmt="%Y-%m-%d %H:%M:%S",)
+class DeferredQueueHandler(QueueHandler):
+    '''
+        Hands records to the listener thread untouched: message formatting, like the I/O, happens off the calling
+        (EReader) thread. Arguments are rendered when the listener gets to them, so callers log field values,
+        not objects they amend afterwards such as a PortfolioLine.
+    '''
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def SetupLogger(level: str = LOG_LEVEL, queue: bool = LOG_QUEUE) -> logging.Logger:
+    '''
+        level: root logger level name, WARNING by default so that only progress and problems are reported
+        queue: log through a non-blocking queue drained by a background thread
+    '''
+    handler: logging.Handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s:%(filename)s:%(funcName)s:%(lineno)d - %(levelname)s - %(message)s",
+                                           datefmt="%Y-%m-%d %H:%M:%S"))
+    if queue:
+        records: "SimpleQueue[logging.LogRecord]" = SimpleQueue()
+        listener = QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)  # flushes what is still queued
+        handler = DeferredQueueHandler(records)
+    logging.basicConfig(handlers=[handler], level=level.upper(), force=True)
     logger = logging.getLogger()
 
     return logger
 
 
-def ibConnect(ipaddr: str) -> Optional[TradeApp]:
+def remaining(deadline: float) -> float:
+    return max(0.0, deadline - time.monotonic())
+
+
+@metrics.timed("connect")
+def ibConnect(ipaddr: str, port: int = PORT, clientId: Optional[int] = CLIENT_ID, timeout: float = CONNECT_TIMEOUT,
+              retries: int = CONNECT_RETRIES, backoff: float = 0.5, factory: Callable[[], TradeApp] = TradeApp) -> Optional[TradeApp]:
     '''
         see https://www.interactivebrokers.com/campus/ibkr-api-page/twsapi-doc/#remote-connection
-    '''   
-    app = TradeApp()
-    app.connect(ipaddr, 7496, clientId=app.reqId)
-    time.sleep(1)
-    api_thread = threading.Thread(target=app.run)
-    time.sleep(.1)
-    api_thread.start()
-    time.sleep(1)
-    if app.isConnected():
-        return app
+        clientId must be unique per TWS instance, a time based one is used by default.
+        The connection is ready once TWS sent nextValidId and managedAccounts; attempts that are refused
+        or not answered within `timeout` are retried `retries` times, sleeping backoff * 2^n in between.
+        factory builds the app, a TradeApp subclass such as simulator.SimulatedTradeApp can be given.
+    '''
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        start = time.monotonic()
+        app = factory()
+        if metrics.enabled:
+            metrics.callbacks(app)
+        app.connect(ipaddr, port, clientId=app.reqId if clientId is None else clientId)
+        if not app.isConnected():  # refused or unreachable, connect() already reported it
+            logger.warning(f"TWS not reachable at {ipaddr}:{port} (attempt {attempt + 1}/{retries + 1})")
+            if app.recorder is not None:  # no log of a failed attempt is left behind
+                app.recorder.discard()
+            continue
+        api_thread = threading.Thread(target=app.run, name=f"EReader {ipaddr}:{port}")
+        api_thread.start()
+        if app.waitHandshake(timeout):
+            logger.warning(f"Connected to {ipaddr}:{port} as client {app.clientId} in {time.monotonic() - start:.3f}s, "
+                           f"accounts {app.managed}")
+            return app
+        reason = app.connectError or f"no handshake within {timeout}s"
+        logger.warning(f"TWS at {ipaddr}:{port} did not accept client {app.clientId}: {reason} (attempt {attempt + 1}/{retries + 1})")
+        app.disconnect()
+        if app.recorder is not None:
+            app.recorder.discard()
     logger.warning("Could not connect to TWS!")
     return None
 
 
-def getAccounts(app: TradeApp) -> Dict[str, Dict[str, Any]]:
+@metrics.timed("accounts")
+def getAccounts(app: TradeApp, timeout: float = TIMEOUT) -> Dict[str, Dict[str, Any]]:
+    deadline = time.monotonic() + timeout
     app.reqMarketDataType(4)
-    time.sleep(.1)
-    app.reqAccountSummary(0, "All", "AccountType")
-    time.sleep(1)
+    reqId = app.newRequest("accountSummary")
+    app.startRequest(reqId)
+    app.scheduler.pace(lambda: app.reqAccountSummary(reqId, "All", "AccountType"))
+    app.waitRequests([reqId], remaining(deadline))
+    app.scheduler.pace(lambda: app.cancelAccountSummary(reqId))
+    app.releaseRequest(reqId)
 
     logger.warning(f"Found the following accounts: {app.accounts}")
 
-    for account in app.accounts.keys():
-        app.reqAccountUpdates(True, account)
-        time.sleep(1)
-
+    # TWS streams one account at a time: subscribe, wait for accountDownloadEnd, unsubscribe
     numLines = 0
-    for account in app.accounts.keys():
-        # print(app.accounts[account])
-        app.reqAccountUpdates(False, account)
-        time.sleep(.1)
-        numLines += len(app.portfolios[account])
+    for account in list(app.accounts.keys()):
+        key = f"account:{account}"
+        app.startRequest(key)
+        app.scheduler.pace(lambda: app.reqAccountUpdates(True, account))
+        app.waitRequests([key], remaining(deadline))
+        app.scheduler.pace(lambda: app.reqAccountUpdates(False, account))
+        numLines += len(app.portfolios.get(account, []))
 
     logger.warning(f"Found {numLines} lines in all portfolios")
 
     return app.accounts
 
 
-def getOpenOrders(app: TradeApp) -> Dict[int, Dict[str, Any]]:
-    time.sleep(1)
+@metrics.timed("orders")
+def getOpenOrders(app: TradeApp, timeout: float = TIMEOUT) -> Dict[int, Dict[str, Any]]:
+    app.startRequest("openOrders")
     app.reqAllOpenOrders()
-    time.sleep(1)
+    app.waitRequests(["openOrders"], timeout)
     numLines = 0
     for account in app.accounts.keys():
-        numLines += len(app.portfolios[account])
+        numLines += len(app.portfolios.get(account, []))
     logger.warning(f"Found {numLines} lines including live orders")
     return app.orders
 
 
-def getCurrencies(app: TradeApp, BaseCur: List[str], cooked: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+@metrics.timed("fx")
+def getCurrencies(app: TradeApp, BaseCur: List[str], cooked: Optional[Dict[str, float]] = None, timeout: float = TIMEOUT,
+                  fxTimeout: float = FX_TIMEOUT) -> Dict[str, float]:
+    deadline = time.monotonic() + timeout
     app.reqMarketDataType(4)
-    time.sleep(.1)
 
     # preparing data for currency conversion
     BaseCur = ['USD', 'CHF', 'EUR'] 
@@ -88,7 +202,7 @@ def getCurrencies(app: TradeApp, BaseCur: List[str], cooked: Optional[Dict[str,
     
     for account in app.portfolios.keys():
         for line in app.portfolios[account]:
-            otherCur.add(line['currency'])
+            otherCur.add(line.currency)
             
     app.currency = dict()
     for cur in list(otherCur):
@@ -98,7 +212,7 @@ def getCurrencies(app: TradeApp, BaseCur: List[str], cooked: Optional[Dict[str,
     query2Cancel = list()
 
     # trying to convert 1 USD in local currency
-    for cur in app.currency.keys():
+    for cur in list(app.currency.keys()):
         if cur != 'USD':
             c = Contract()
             c.symbol = 'USD'
@@ -106,15 +220,14 @@ def getCurrencies(app: TradeApp, BaseCur: List[str], cooked: Optional[Dict[str,
             c.exchange = "IDEALPRO"
             c.primaryExchange = "IDEALPRO"
             c.currency = cur
-            id = list(app.currency.keys()).index(cur)
+            id = app.newRequest("fx", (cur, 'USD', False))
             query2Cancel.append(id)
-            logger.debug(f"Trying to convert USD in {cur} (reqID:{id})")
-            app.reqMktData(id, c, "", True, False, [])
-            time.sleep(.1)
-    time.sleep(.5)
+            logger.debug("Trying to convert USD in %s (reqID:%d)", cur, id)
+            app.scheduler.submit(id, lambda id=id, c=c: app.reqMktData(id, c, "", True, False, []), remaining(deadline))
+    app.scheduler.drain(remaining(deadline) / 2)
 
     # in case of failure, trying to convert local currency to USD
-    for cur in app.currency.keys():
+    for cur in list(app.currency.keys()):
         if cur != 'USD' and app.currency[cur] < 0:
             c = Contract()
             c.currency = 'USD'
@@ -122,139 +235,248 @@ def getCurrencies(app: TradeApp, BaseCur: List[str], cooked: Optional[Dict[str,
             c.exchange = "IDEALPRO"
             c.primaryExchange = "IDEALPRO"
             c.symbol = cur
-            id = 1000 + list(app.currency.keys()).index(cur)
+            id = app.newRequest("fx", (cur, 'USD', True))  # quoted the other way round
             query2Cancel.append(id)
-            logger.debug(f"Trying to convert {cur} in USD (reqID:{id})")
-            app.reqMktData(id, c, "", True, False, [])
-            time.sleep(.1)
-    time.sleep(.5)
+            logger.debug("Trying to convert %s in USD (reqID:%d)", cur, id)
+            app.scheduler.submit(id, lambda id=id, c=c: app.reqMktData(id, c, "", True, False, []), remaining(deadline))
+    app.scheduler.drain(remaining(deadline) / 2)
+
+    # still no USD leg: triangulate through the EUR or CHF quote of the currency
+    app.crosses = dict()
+    for cur in list(app.currency.keys()):
+        if cur in TRIANGULATE or app.currency[cur] > 0:
+            continue
+        for via in TRIANGULATE:
+            if app.currency.get(via, -1) > 0:
+                c = Contract()
+                c.symbol = via
+                c.secType = 'CASH'
+                c.exchange = "IDEALPRO"
+                c.primaryExchange = "IDEALPRO"
+                c.currency = cur
+                id = app.newRequest("fx", (cur, via, False))
+                query2Cancel.append(id)
+                logger.debug("Trying to convert %s in %s (reqID:%d)", via, cur, id)
+                app.scheduler.submit(id, lambda id=id, c=c: app.reqMktData(id, c, "", True, False, []), remaining(deadline))
+    app.scheduler.drain(remaining(deadline))
+    app.scheduler.report("currency quotes")
+    for cur in list(app.currency.keys()):
+        for via in TRIANGULATE:
+            if app.currency[cur] <= 0 and (cur, via) in app.crosses and app.currency.get(via, -1) > 0:
+                app.currency[cur] = app.crosses[(cur, via)] * app.currency[via]
+                logger.info("%s.USD triangulated through %s: %s", cur, via, app.currency[cur])
 
     for q in query2Cancel:
-        app.cancelAccountSummary(q)
-        time.sleep(.1)
+        app.scheduler.pace(lambda q=q: app.cancelMktData(q))
+        app.releaseRequest(q)
 
     if cooked:
         app.currency = {**app.currency, **cooked}
         
-    for cur in app.currency.keys():
-        rate = app.currency[cur]
-        if rate <= 0:
-            app.currency[cur] = forex_api.convert(cur, "USD")
+    missing = [cur for cur, rate in app.currency.items() if rate <= 0]
+    metrics.count("fx.tws", sum(1 for rate in app.currency.values() if rate > 0))
+    metrics.count("fx.web", len(missing))
+    late = set()
+    if missing:
+        from cachedfaz import UNRESOLVED
+        with metrics.phase("fx.web"):
+            rates = forexApi().convert_many(missing, "USD", timeout=fxTimeout)
+            forexApi().flush()  # lookups past the deadline are committed by the cache timer
+        app.currency.update(rates)
+        late = {cur for cur, rate in rates.items() if rate == UNRESOLVED}
         
     for cur in app.currency.keys():
-        if app.currency[cur] < 0:
+        if cur in late:
+            logger.error(f"Currency {cur}.USD still unresolved after {fxTimeout}s -- assessement may be wrong")
+        elif app.currency[cur] < 0:
             logger.error(f"Could not manage to get currency {cur}.USD -- assessement may be wrong")
             
     logger.warning(f"Managed to get following currencies (base 1=USD): {app.currency}")
+    app.fx = fxMatrix(app.currency, BaseCur)
         
     return app.currency  
 
 
-def getAssetDetails(app: TradeApp) -> None:
-    for account in app.portfolios.keys():
-        logger.info("GETTING STOCK DETAILS AND PRICE MAGNIFIER")
-        app.contract = dict()
-        for idx, line in enumerate(app.portfolios[account]):
-            c = Contract()
-            c.conId =           line['conId']
-            c.secType =         line['secType']
-            c.exchange =        line['primaryExchange']
-            c.primaryExchange = line['primaryExchange']
-            c.symbol =          line['symbol']
-            c.currency =        line['currency']
-            c.localSymbol =     line['localSymbol']
-            app.reqContractDetails(2000 + idx, c)
-            time.sleep(.1)
-
-
-        time.sleep(2)
-
-        for idx, line in enumerate(app.portfolios[account]):
-            if idx in app.contract.keys():
-                contractDetails = app.contract[idx]
-                pfcontract = {}
-                pfcontract['stockType'] =      getattr(contractDetails, 'stockType', "")
-                # if pfcontract['stockType'] != "RIGHT":  # issuance of new shares - not a portofio position
-                pfcontract['longName'] =       getattr(contractDetails, 'longName', "")
-                pfcontract['industry'] =       getattr(contractDetails, 'industry', "")
-                pfcontract['category'] =       getattr(contractDetails, 'category', "")
-                pfcontract['subcategory'] =    getattr(contractDetails, 'subcategory', "")
-                pfcontract['priceMagnifier'] = int(getattr(contractDetails, 'priceMagnifier', 1.0))
-                pfcontract['minSize'] =        float(getattr(contractDetails, 'minSize', 0.0001))
-                pfcontract['sizeIncrement'] =  float(getattr(contractDetails, 'sizeIncrement', 1.0))
-                pfcontract['minTick'] =        float(getattr(contractDetails, 'minTick', 0.0001))                    
-                app.portfolios[account][idx] = { **app.portfolios[account][idx], **pfcontract }
+def fxMatrix(rates: Dict[str, float], BaseCur: List[str]) -> pl.DataFrame:
+    '''
+        Conversion factors from every known currency (rows) to every base currency (fx.{base} columns),
+        computed once from the units of each currency for 1 USD. A factor is null when either rate is unknown,
+        'valid' tells whether the source currency itself could be priced.
+    '''
+    source = pl.DataFrame({'currency': list(rates.keys()), '_rate': [float(rate) for rate in rates.values()]},
+                          schema={'currency': pl.String, '_rate': pl.Float64})
+    return source.select(
+        'currency',
+        (pl.col('_rate') > 0).alias('valid'),
+        *[pl.when(pl.col('_rate') > 0).then(float(rates.get(base, -1)) / pl.col('_rate')).alias(f"fx.{base}")
+          if rates.get(base, -1) > 0 else pl.lit(None, dtype=pl.Float64).alias(f"fx.{base}")
+          for base in BaseCur],
+    )
+
+
+def contractInfo(contractDetails: Any) -> ContractInfo:
+    return ContractInfo(
+        stockType=      getattr(contractDetails, 'stockType', ""),
+        # if stockType != "RIGHT":  # issuance of new shares - not a portofio position
+        longName=       getattr(contractDetails, 'longName', ""),
+        industry=       getattr(contractDetails, 'industry', ""),
+        category=       getattr(contractDetails, 'category', ""),
+        subcategory=    getattr(contractDetails, 'subcategory', ""),
+        priceMagnifier= int(getattr(contractDetails, 'priceMagnifier', 1.0)),
+        minSize=        float(getattr(contractDetails, 'minSize', 0.0001)),
+        sizeIncrement=  float(getattr(contractDetails, 'sizeIncrement', 1.0)),
+        minTick=        float(getattr(contractDetails, 'minTick', 0.0001)),
+    )
+
+
+def getAssetDetails(app: TradeApp, timeout: float = TIMEOUT, accounts: Optional[List[str]] = None) -> None:
+    for _ in iterAssetDetails(app, timeout, accounts):
+        pass
+
+
+def iterAssetDetails(app: TradeApp, timeout: float = TIMEOUT, accounts: Optional[List[str]] = None) -> Iterator[str]:
+    '''
+        Enriches the lines with contract details (of all accounts, or of the given ones) in a single pass:
+        the requests of every account are sent up front, and each account is yielded, in order, as soon as
+        its own contracts are known, possibly while later accounts are still being requested.
+        A contract is looked up once whatever the number of lines holding it.
+    '''
+    deadline = time.monotonic() + timeout
+    logger.info("GETTING STOCK DETAILS AND PRICE MAGNIFIER")
+    contracts = contractDb()
+    accounts = list(app.portfolios.keys()) if accounts is None else [a for a in accounts if a in app.portfolios]
+
+    found: Dict[int, ContractInfo] = dict()
+    requested: Dict[int, int] = dict()  # conId -> reqId
+    keys: Dict[str, set] = dict()  # account -> reqIds its lines wait for
+    cached = 0
+
+    def complete(account: str) -> None:
+        for line in list(app.portfolios[account]):
+            if line.details is not None:
+                continue
+            if line.conId not in found and line.conId in app.contract.keys():
+                found[line.conId] = contractInfo(app.contract[line.conId])
+                contracts.set(line.conId, found[line.conId])
+            if line.conId in found:
+                line.details = found[line.conId]  # shared by all the lines of the contract
             else:
-                logger.error(f"Missing contract {app.portfolios[account][idx]['localSymbol']}")
+                logger.error(f"Missing contract {line.localSymbol}")
+
+    def answered(account: str) -> bool:
+        with app.pendingCond:
+            return not app.pending & keys[account]
+
+    ready = 0  # accounts[:ready] were yielded
+    for account in accounts:
+        with metrics.phase("contracts"):  # time spent waiting for the consumer excluded
+            keys[account] = set()
+            for line in list(app.portfolios[account]):
+                conId = line.conId
+                if line.details is not None or conId in found:
+                    continue
+                if conId in requested:
+                    keys[account].add(requested[conId])
+                    continue
+                pfcontract = contracts.get(conId)
+                if pfcontract is not None:
+                    found[conId] = pfcontract
+                    cached += 1
+                    continue
+                c = Contract()
+                c.conId =           line.conId
+                c.secType =         line.secType
+                c.exchange =        line.primaryExchange
+                c.primaryExchange = line.primaryExchange
+                c.symbol =          line.symbol
+                c.currency =        line.currency
+                c.localSymbol =     line.localSymbol
+                reqId = app.newRequest("contractDetails", conId)
+                requested[conId] = reqId
+                keys[account].add(reqId)
+                app.scheduler.submit(reqId, lambda reqId=reqId, c=c: app.reqContractDetails(reqId, c), remaining(deadline))
+        while ready < len(keys) and answered(accounts[ready]):
+            with metrics.phase("contracts"):
+                complete(accounts[ready])
+            ready += 1
+            yield accounts[ready - 1]
+
+    for account in accounts[ready:]:
+        with metrics.phase("contracts"):
+            app.waitRequests(keys[account], remaining(deadline))
+            complete(account)
+        yield account
+
+    for reqId in requested.values():
+        app.releaseRequest(reqId)
+    contracts.flush()  # releases the SQLite write lock for other processes
+    app.scheduler.report(f"contract details ({len(found)} contracts, {cached} from cache)")
 
 
 def ibDisconnect(app: TradeApp) -> None:
     app.disconnect()
     
 
-def computeThings(app: TradeApp, BaseCur: List[str]) -> Dict[str, List[Dict[str, Any]]]:
-    for account in app.portfolios.keys():
-        
-        for k in app.accounts[account].keys():
+@metrics.timed("compute")
+def computeThings(app: TradeApp, BaseCur: List[str], accounts: Optional[List[str]] = None) -> Dict[str, pl.DataFrame]:
+    '''
+        Converts amounts in every base currency, adds the TOTAL (net liquidation) and CASH lines and the weight
+        of each position, as Polars expressions over a single frame holding the lines of all accounts
+        (or of the given ones only).
+    '''
+    usd = BaseCur[0]
+    marketValueUSD = f"marketValue.{usd}"
+
+    with app.lock:
+        portfolios = {account: list(lines) for account, lines in app.portfolios.items() if accounts is None or account in accounts}
+    for account in portfolios.keys():
+        for k in app.accounts.get(account, {}).keys():
             if k.startswith('NetLiquidation.'):
-                logger.info(f"NetLiquidation  k:'{k}'  val:'{app.accounts[account][k]}'  ")
-                grandtotalCur = k[len(k) - 3:]
-                grandtotalVal = app.accounts[account][k] 
-                app.portfolios[account].append({
-                    'orderAct': '',
-                    'orderVal': 0,
-                    'orderPos': 0,
-                    'secType': "TOTAL",
-                    'currency': grandtotalCur,
-                    'marketValue': grandtotalVal,
-                })
+                logger.info("NetLiquidation  k:'%s'  val:'%s'  ", k, app.accounts[account][k])
+                portfolios[account].append(PortfolioLine(
+                    orderAct='',
+                    orderVal=0.0,
+                    orderPos=0.0,
+                    secType="TOTAL",
+                    currency=k[len(k) - 3:],
+                    marketValue=app.accounts[account][k],
+                ))
                 break
-
-        totalAsset = dict(zip(BaseCur, [0] * len(BaseCur)))
-        usd = BaseCur[0]
-        marketValueUSD = f"marketValue.{usd}"
-        
-        for idx, line in enumerate(app.portfolios[account]):
-            # action = line['orderAct']
-            # if action != "":  # line from the order book
-            #    try:
-            #        # applying magnifier for ongoing orders only (for example prices expressed in penny /100p -> 1£)
-            #        line['orderVal'] /= app.portfolios[account][idx]['priceMagnifier']
-            #    except:
-            #        logger.info(f"cannot apply magnifier for {app.portfolios[account][idx]['symbol']} current order")
-            
-            for column in ['marketPrice', 'marketValue', 'averageCost',  'unrealizedPNL', 'realizedPNL', 'orderVal']:
-                for currency in BaseCur:
-                    if column in line:
-                        cur = line['currency']
-                        if app.currency[cur] > 0: # value is neg if conversion is unknown
-                            val = line[column]
-                            valCur = val / app.currency[cur] * app.currency[currency]
-                            # valCur /= magnifier if column in ['marketPrice', 'averageCost'] else 1.0
-                            # app.portfolios[account][idx][f"{column}.{currency}"] = valCur
-                            line[f"{column}.{currency}"] = valCur
-                            logger.debug(f"convert currency {val} {cur} -> {valCur} {currency}, conversion rate {app.currency[cur] * app.currency[currency]}") 
-                        if column == 'marketValue' and line['secType'] not in ['TOTAL', 'CASH']:
-                            totalAsset[currency] += valCur
-
-        if len(app.portfolios[account]) > 0 and marketValueUSD in app.portfolios[account][-1]:
-            for idx, line in enumerate(app.portfolios[account]):
-                action = line['orderAct']
-                if line['secType'] != "TOTAL" and action == "" and marketValueUSD in line:  # line from the portfolio
-                    line['pct'] = line[marketValueUSD] / app.portfolios[account][-1][marketValueUSD] * 100.0
-                # else:
-                #     logger.warning(f"missing computation for asset id {idx} - won't compute percentages")
-        # else:
-        #    logger.warning(f"missing grand total in usd - won't compute percentages")
-        
-        app.portfolios[account].append({'orderAct': '', 'secType': "CASH"})
-        logger.debug(f"-1 {app.portfolios[account][-1]}")  # CASH line
-        logger.debug(f"-2 {app.portfolios[account][-2]}")  # TOTAL line
-        logger.debug(f"totalAsset {totalAsset}")           # value of all assets
-        
-        for currency in BaseCur:
-            app.portfolios[account][-1][f"marketValue.{currency}"] = app.portfolios[account][-2][f"marketValue.{currency}"] - totalAsset[currency]
-            
-        app.portfolios[account][-1]['pct'] = 100.0 * (app.portfolios[account][-2][marketValueUSD] - totalAsset[usd]) / app.portfolios[account][-2][marketValueUSD]
-    
-    return app.portfolios
+    if not portfolios:
+        return dict()
+
+    df = toFrame(portfolios).with_row_index('_row')
+    fx = getattr(app, 'fx', None)
+    if fx is None or any(f"fx.{currency}" not in fx.columns for currency in BaseCur):
+        fx = fxMatrix(app.currency, BaseCur)
+    df = df.join(fx, on='currency', how='left').sort('_row')  # null factor if conversion is unknown
+    df = df.with_columns([
+        (pl.col(column) * pl.col(f"fx.{currency}")).alias(f"{column}.{currency}")
+        for column in CONVERTED for currency in BaseCur
+    ])
+
+    isTotal = pl.col('secType') == "TOTAL"
+    isAsset = ~pl.col('secType').is_in(["TOTAL", "CASH"])
+    grandTotal = {currency: pl.col(f"marketValue.{currency}").filter(isTotal).first().over('account') for currency in BaseCur}
+    df = df.with_columns(
+        pl.when(~isTotal & (pl.col('orderAct') == "")).then(pl.col(marketValueUSD) / grandTotal[usd] * 100.0).alias('pct')
+    )
+
+    # CASH line: what the net liquidation value holds beside the assets
+    cash = df.group_by('account', maintain_order=True).agg(
+        [pl.col(f"marketValue.{currency}").filter(isTotal).first().alias(f"_total.{currency}") for currency in BaseCur] +
+        [pl.col(f"marketValue.{currency}").filter(isAsset).sum().alias(f"_asset.{currency}") for currency in BaseCur]
+    ).select(
+        'account',
+        pl.lit('').alias('orderAct'),
+        pl.lit("CASH").alias('secType'),
+        *[(pl.col(f"_total.{currency}") - pl.col(f"_asset.{currency}")).alias(f"marketValue.{currency}") for currency in BaseCur],
+        (100.0 * (pl.col(f"_total.{usd}") - pl.col(f"_asset.{usd}")) / pl.col(f"_total.{usd}")).alias('pct'),
+        pl.lit(len(df), dtype=pl.UInt32).alias('_row'),
+    )
+    logger.debug("cash lines %s", cash)
+
+    schema = outputSchema(BaseCur)
+    df = pl.concat([df, cash], how='diagonal_relaxed')
+    return {account[0]: part.sort('_row').select([pl.col(name).cast(dtype) for name, dtype in schema.items()])
+            for account, part in df.partition_by('account', as_dict=True, maintain_order=True).items()}
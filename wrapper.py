@@ -6,30 +6,155 @@ from ibapi.order import Order
 import time
 import logging
 import socket
-from typing import Dict, List, Any
+import threading
+from typing import Dict, Hashable, Iterable, List, Any, Optional, Set, Tuple
 import ibapi
+from scheduler import RequestScheduler
+from records import PortfolioLine
 
 
 socket.setdefaulttimeout(10.0)
 
 logger = logging.getLogger()
 
+# error codes received with a reqId that do not terminate the request
+# (farm status notifications, delayed market data warnings, ...)
+NON_FATAL_ERRORS = {2104, 2106, 2107, 2108, 2119, 2158, 10089, 10090, 10167, 10168}
+# error codes received without reqId that make the connection handshake fail
+# (connect failed, client id already in use, not connected, socket error, ...)
+HANDSHAKE_ERRORS = {326, 502, 504, 507, 509}
+_UNSET = object()
+
 
 class TradeApp(EWrapper, EClient):
-    accounts: Dict[str, Dict[str, Any]] = dict()
-    portfolios: Dict[str, List[Dict[str, Any]]] = dict()
-    currency: Dict[str, float] = dict()
-    contract: Dict[int, Any] = dict()
-    orders: Dict[int, Dict[str, Any]] = dict()
-    reqId: int = -1
+    accounts: Dict[str, Dict[str, Any]]
+    portfolios: Dict[str, List[PortfolioLine]]
+    currency: Dict[str, float]
+    contract: Dict[int, Any]  # ContractDetails by conId
+    orders: Dict[int, Dict[str, Any]]
+    reqId: int
     
     
     def __init__(self): 
         EClient.__init__(self, self)
+        # per instance, so that several connections can live in one process
+        self.accounts = dict()
+        self.portfolios = dict()
+        self.currency = dict()  # units of each currency for 1 USD, negative if unknown
+        self.crosses: Dict[Tuple[str, str], float] = dict()  # (currency, EUR or CHF) -> units of currency for 1 EUR/CHF
+        self.fx: Optional[Any] = None  # conversion matrix built by getCurrencies, see utils.fxMatrix
+        self.contract = dict()
+        self.orders = dict()
         self.reqId = 3000 + (int(time.time()) % 6999)
+        self.requests: Dict[int, Tuple[str, Any]] = dict()  # reqId -> (purpose, payload) of the live requests
+        self.lastReqId = 0
+        self.recorder: Optional[Any] = None  # replay.CallbackRecorder logging this session, see replay.record
+        self.pending: Set[Hashable] = set()
+        self.pendingCond = threading.Condition()
+        self.scheduler = RequestScheduler(self)
+        self.lock = threading.RLock()  # guards portfolios against the EReader thread while they are read or rebuilt
+        self.positions: Dict[Tuple[str, int], PortfolioLine] = dict()  # (account, conId) -> line, for live updates
+        self.dirty: Set[str] = set()  # accounts changed since the last takeDirty()
+        self.changed = threading.Event()
+        self.refreshingOrders = False  # set by daemon.refreshOpenOrders, which tells itself which accounts changed
+        self.managed: List[str] = list()  # accounts reachable through this connection (managedAccounts)
+        self.nextOrderId: Optional[int] = None
+        self.handshake = threading.Event()  # set once both nextValidId and managedAccounts arrived, or on failure
+        self.connectError: Optional[Tuple[int, str]] = None
         logger.warning(f"ibapi version: {ibapi.__version__} (should be 10.14.1)")
 
 
+    def markDirty(self, accountName: str) -> None:
+        with self.lock:
+            self.dirty.add(accountName)
+        self.changed.set()
+
+
+    def takeDirty(self) -> Set[str]:
+        '''
+            Accounts updated since the previous call.
+        '''
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            self.changed.clear()
+        return dirty
+
+
+    def nextValidId(self, orderId: int) -> None:
+        self.nextOrderId = orderId
+        if self.managed:
+            self.handshake.set()
+
+
+    def managedAccounts(self, accountsList: str) -> None:
+        self.managed = [account for account in accountsList.split(",") if account]
+        if self.nextOrderId is not None:
+            self.handshake.set()
+
+
+    def waitHandshake(self, timeout: float) -> bool:
+        '''
+            Block until TWS sent nextValidId and managedAccounts, the first messages of a usable session.
+            Returns False on timeout or if TWS refused the connection (see connectError).
+        '''
+        return self.handshake.wait(timeout) and self.connectError is None
+
+
+    def newRequest(self, purpose: str, payload: Any = None) -> int:
+        '''
+            Allocate a reqId, never reused during the session, and register what its answers are about.
+        '''
+        with self.pendingCond:
+            self.lastReqId += 1
+            self.requests[self.lastReqId] = (purpose, payload)
+            if self.recorder is not None:
+                self.recorder.write('request', purpose, (self.lastReqId, purpose, payload))
+            return self.lastReqId
+
+
+    def releaseRequest(self, reqId: int) -> None:
+        '''
+            Forget a request once cancelled or complete; late answers to it are then ignored.
+        '''
+        with self.pendingCond:
+            self.requests.pop(reqId, None)
+        if self.recorder is not None:
+            self.recorder.write('release', "", reqId)
+
+
+    def startRequest(self, key: Hashable) -> None:
+        '''
+            Flag a request as outstanding until endRequest(key) is called from its *End callback.
+        '''
+        with self.pendingCond:
+            self.pending.add(key)
+
+
+    def endRequest(self, key: Hashable) -> None:
+        with self.pendingCond:
+            if key in self.pending:
+                self.pending.discard(key)
+                self.pendingCond.notify_all()
+
+
+    def waitRequests(self, keys: Optional[Iterable[Hashable]] = None, timeout: Optional[float] = None, atMost: int = 0) -> bool:
+        '''
+            Block until at most `atMost` of the given requests (all outstanding ones if keys is None) are still pending.
+            Returns False if the timeout expired first; the remaining requests are then forgotten.
+        '''
+        if keys is not None and not isinstance(keys, (set, frozenset)):
+            keys = set(keys)
+        with self.pendingCond:
+            def done() -> bool:
+                return len(self.pending if keys is None else self.pending & keys) <= atMost
+            ok = self.pendingCond.wait_for(done, timeout)
+            if not ok:
+                late = set(self.pending) if keys is None else self.pending & keys
+                logger.error(f"Timeout after {timeout}s, {len(late)} request(s) still pending: {sorted(map(str, late))[:10]}")
+                self.pending -= late
+            return ok
+
+
 
     def accountSummary(self, reqId: int, account: str, tag: str, value: str, currency: str) -> None:
         # print("AccountSummary. ReqId:", reqId, "Account:", account,"Tag: ", tag, "Value:", value, "Currency:", currency)
@@ -37,8 +162,8 @@ class TradeApp(EWrapper, EClient):
     
     
     def accountSummaryEnd(self, reqId: int) -> None:
-        pass
         # print("AccountSummaryEnd. ReqId:", reqId)
+        self.endRequest(reqId)
 
 
     def updateAccountValue(self, key: str, val: str, cur: str, accountName: str) -> None:
@@ -51,38 +176,51 @@ class TradeApp(EWrapper, EClient):
         except:
             valo = val
             pass
+        changed = self.accounts[accountName].get(k, _UNSET) != valo  # TWS resends unchanged values
         self.accounts[accountName][k] = valo
-        logger.info(f"key:'{key}' val:'{val}' cur:'{cur}' accountName:'{accountName}' --> self.accounts[{accountName}][{k}]={valo} {type(valo)}")
+        logger.info("key:'%s' val:'%s' cur:'%s' accountName:'%s' --> self.accounts[%s][%s]=%s %s", key, val, cur, accountName, accountName, k, valo, type(valo))
         if len(cur):
-            self.currency[cur] = 1
+            self.currency.setdefault(cur, -1)  # a live update must not clobber a known rate
+        if changed:
+            self.markDirty(accountName)
     
     
     def updatePortfolio(self, contract: Contract, position: float, marketPrice: float, marketValue: float, averageCost: float, unrealizedPNL: float, realizedPNL: float, accountName: str) -> None:
          
-        logger.info(f"UpdatePortfolio. Symbol:{contract}, Position:{position}, "
-                    f"MarketPrice:{marketPrice}, MarketValue:{marketValue}, "
-                    f"AverageCost:{averageCost}, UnrealizedPNL:{unrealizedPNL}, "
-                    f"RealizedPNL:{realizedPNL}, AccountName:{accountName}")
+        logger.info("UpdatePortfolio. Symbol:%s, Position:%s, MarketPrice:%s, MarketValue:%s, AverageCost:%s, "
+                    "UnrealizedPNL:%s, RealizedPNL:%s, AccountName:%s",
+                    contract, position, marketPrice, marketValue, averageCost, unrealizedPNL, realizedPNL, accountName)
          
-        if accountName not in self.portfolios.keys():
-            self.portfolios[accountName] = []
-            
-        self.portfolios[accountName].append({
-            'symbol': contract.symbol,
-            'longName': contract.symbol,
-            'secType': contract.secType,
-            'primaryExchange': contract.primaryExchange,
-            'currency': contract.currency,
-            'conId': contract.conId,
-            'localSymbol': contract.localSymbol,
-            'position': float(position),
-            'marketPrice': marketPrice,
-            'marketValue': marketValue,
-            'averageCost': averageCost,
-            'unrealizedPNL': unrealizedPNL,
-            'realizedPNL': realizedPNL,
-            'orderAct': '',
-        })
+        with self.lock:
+            if accountName not in self.portfolios.keys():
+                self.portfolios[accountName] = []
+
+            line = self.positions.get((accountName, contract.conId))
+            if line is None:  # new position, otherwise a live update of a known one
+                line = PortfolioLine(
+                    symbol=contract.symbol,
+                    longName=contract.symbol,
+                    secType=contract.secType,
+                    primaryExchange=contract.primaryExchange,
+                    currency=contract.currency,
+                    conId=contract.conId,
+                    localSymbol=contract.localSymbol,
+                    orderAct='',
+                )
+                self.positions[(accountName, contract.conId)] = line
+                self.portfolios[accountName].append(line)
+                changed = True
+            else:  # resent on every subscription and periodically: only a different value is a change
+                changed = (line.position, line.marketPrice, line.marketValue, line.averageCost, line.unrealizedPNL, line.realizedPNL) != \
+                          (float(position), marketPrice, marketValue, averageCost, unrealizedPNL, realizedPNL)
+            line.position = float(position)
+            line.marketPrice = marketPrice
+            line.marketValue = marketValue
+            line.averageCost = averageCost
+            line.unrealizedPNL = unrealizedPNL
+            line.realizedPNL = realizedPNL
+        if changed:
+            self.markDirty(accountName)
         # .symbol, "SecType:", secType, "Exchange:",exchange
         
         
@@ -92,26 +230,26 @@ class TradeApp(EWrapper, EClient):
       
         
     def accountDownloadEnd(self, accountName: str) -> None:
-        pass
         # print("AccountDownloadEnd. Account:", accountName)
+        self.endRequest(f"account:{accountName}")
     
 
     def symbolSamples(self, reqId: int, contractDescriptions: ListOfContractDescription) -> None:
         if len(contractDescriptions):
-            logger.info(f"Symbol Samples. {contractDescriptions[0]}")
+            logger.info("Symbol Samples. %s", contractDescriptions[0])
             self.contract[reqId] = contractDescriptions[0].contract
         else:
             self.contract[reqId] = ""
 
 
     def contractDetails(self, reqId: int, contractDetails: ContractDetails) -> None:
-        logger.info(f"{reqId}, {contractDetails}")
-        self.contract[reqId - 2000] = contractDetails
+        logger.info("%s, %s", reqId, contractDetails)
+        self.contract[contractDetails.contract.conId] = contractDetails
 
 
     def contractDetailsEnd(self, reqId: int) -> None:
-        logger.info(f"contractDetailsEnd {reqId}")
-        pass
+        logger.info("contractDetailsEnd %s", reqId)
+        self.endRequest(reqId)
       
         
     def headTimestamp(self, reqId: int, headTimestamp: str) -> None:
@@ -130,27 +268,26 @@ class TradeApp(EWrapper, EClient):
             Close Price	9	The last available closing price for the previous day. 
         '''
         if tickType == 9: 
-            if reqId < 1000:
-                try:
-                    cur = list(self.currency.keys())[reqId]
-                    self.currency[cur] = price
-                    logger.info(f"{reqId}, {tickType}, {price}, {attrib} -> {cur} {self.currency[cur]}")
-                except:
-                    ks = list(self.currency.keys())
-                    logger.error(f"cannot find currency reqId:{reqId} keys:{ks}")
-            else:  
-                reqId = reqId - 1000
-                try:
-                    cur = list(self.currency.keys())[reqId]
-                    self.currency[cur] = 1.0 / price
-                    logger.info(f"{reqId}, {tickType}, {price}, {attrib} -> {cur} {self.currency[cur]}")
-                except:
-                    ks = list(self.currency.keys())
-                    logger.error(f"cannot find currency reqId:{reqId} keys:{ks}")
+            purpose, payload = self.requests.get(reqId, (None, None))
+            if purpose == "fx":
+                cur, via, inverse = payload
+                rate = 1.0 / price if inverse else price
+                if via == 'USD':
+                    self.currency[cur] = rate
+                else:
+                    self.crosses[(cur, via)] = rate  # units of cur for 1 via
+                logger.info("%s, %s, %s, %s -> %s.%s %s", reqId, tickType, price, attrib, cur, via, rate)
+            else:
+                logger.error(f"unexpected close price for reqId:{reqId} ({purpose})")
         else:
-            logger.info(f"Not used Ticktype {tickType}, {reqId}, {price}, {attrib}")
+            logger.info("Not used Ticktype %s, %s, %s, %s", tickType, reqId, price, attrib)
     
     
+    def tickSnapshotEnd(self, reqId: int) -> None:
+        logger.info("tickSnapshotEnd %s", reqId)
+        self.endRequest(reqId)
+
+
     def tickSize(self, reqId: int, tickType: int, size: int) -> None:
         pass
 
@@ -169,30 +306,34 @@ class TradeApp(EWrapper, EClient):
 
     def openOrder(self, orderId: int, contract: Contract, order: Order, orderState: Any) -> None:
         accountName = order.account 
-        if accountName not in self.portfolios.keys():
-            self.portfolios[accountName] = []
+        with self.lock:
+            if accountName not in self.portfolios.keys():
+                self.portfolios[accountName] = []
         sign = -1.0 if order.action == "SELL" else 1
-        line = { # 
-            'orderId': orderId,    
-            'orderAlgoId': order.algoId,    
-            'orderRef': order.orderRef,    
-            'orderType': order.orderType,    
-            'orderAct': order.action,
-            'orderVal': sign * float(order.totalQuantity) * order.lmtPrice,   # TODO / check if priceMagnifier has to be applied
-            'orderPos': float(order.totalQuantity),
-            'longName': contract.symbol,
-            'symbol': contract.symbol,
-            'conId': contract.conId,
-            'secType': contract.secType,
-            'primaryExchange': contract.primaryExchange,
-            'currency': contract.currency,
-            'localSymbol': contract.localSymbol,
-        }
-        logger.info(f"openOrder orderId:'{orderId}' contract:'{contract}' order:'{order}' orderState:'{orderState}' {type(order.totalQuantity)} -> {line}")
+        line = PortfolioLine(
+            orderId=orderId,
+            orderAlgoId=order.algoId,
+            orderRef=order.orderRef,
+            orderType=order.orderType,
+            orderAct=order.action,
+            orderVal=sign * float(order.totalQuantity) * order.lmtPrice,   # TODO / check if priceMagnifier has to be applied
+            orderPos=float(order.totalQuantity),
+            longName=contract.symbol,
+            symbol=contract.symbol,
+            conId=contract.conId,
+            secType=contract.secType,
+            primaryExchange=contract.primaryExchange,
+            currency=contract.currency,
+            localSymbol=contract.localSymbol,
+        )
+        logger.info("openOrder orderId:'%s' contract:'%s' order:'%s' orderState:'%s' %s -> %s %s X %s for %s", orderId, contract, order, orderState,
+                    type(order.totalQuantity), line.orderAct, line.orderPos, line.localSymbol, line.orderVal)
 
         self.orders[order.orderId] = { 
             'accountName': accountName,
-            'payload': line
+            'payload': line,
+            'lmtVal': line.orderVal,
+            'listed': False,
         }
         
         
@@ -200,32 +341,43 @@ class TradeApp(EWrapper, EClient):
                     lastFillPrice: float, clientId: int, whyHeld: str, mktCapPrice: float) -> None:
         data = self.orders[orderId]
         accountName, line = data['accountName'], data['payload']
-        logger.info(line)
-        pos = -float(remaining) if line['orderAct'] == "SELL" else float(remaining)
+        pos = -float(remaining) if line.orderAct == "SELL" else float(remaining)
         val = 0.0
         for newPrice in [avgFillPrice, lastFillPrice, mktCapPrice, ]:
             if newPrice > 0.0:
                 val = float(newPrice) * pos
         if val == 0.0:
-            val = line['orderVal']
-        line = {**line, **{
-                            'orderPos': pos,
-                            'orderVal': val,  # TODO / check if priceMagnifier has to be applied
-        }}
-        logger.info(f"orderStatus {orderId} {status} {filled} {remaining} {avgFillPrice} {permId} {parentId} {lastFillPrice} {clientId} {whyHeld}  {mktCapPrice} -> {line} ")
+            val = data['lmtVal']
+        line.orderPos = pos
+        line.orderVal = val  # TODO / check if priceMagnifier has to be applied
+        # field values rather than the line, which later callbacks amend before a queued record is rendered
+        logger.info("orderStatus %s %s %s %s %s %s %s %s %s %s  %s -> %s %s X %s for %s", orderId, status, filled, remaining, avgFillPrice, permId,
+                    parentId, lastFillPrice, clientId, whyHeld, mktCapPrice, line.orderAct, pos, line.localSymbol, val)
         if status in ['Submitted', 'PreSubmitted', 'PendingSubmit']:
-            self.portfolios[accountName].append(line)
+            if not data['listed']:  # status updates of an order already listed amend it in place
+                with self.lock:
+                    self.portfolios[accountName].append(line)
+                data['listed'] = True
+            if not self.refreshingOrders:
+                self.markDirty(accountName)
         else:
-            logger.warning(f"orderStatus Order  {line['orderAct']} {line['orderPos']} X {line['symbol']} "
-                           f"for {line['orderVal']}{line['currency']} has unforseen status '{status}', "
+            logger.warning(f"orderStatus Order  {line.orderAct} {line.orderPos} X {line.symbol} "
+                           f"for {line.orderVal}{line.currency} has unforseen status '{status}', "
                            f"won't be added to portfolio")
 
 
     def openOrderEnd(self) -> None:
         logger.info("OpenOrderEnd")
+        self.endRequest("openOrders")
 
 
     def error(self, reqId: TickerId, errorCode: int, errorString: str, advancedOrderRejectJson: str = "") -> None:
         if reqId != -1:
             super().error(reqId, errorCode, errorString)
             logger.error(f"Error. Id:{reqId}, Code:{errorCode}, Msg:{errorString}, AdvancedOrderRejectJson:{advancedOrderRejectJson}")
+            if errorCode not in NON_FATAL_ERRORS:
+                self.endRequest(reqId)  # no *End callback will follow
+        elif errorCode in HANDSHAKE_ERRORS:
+            logger.error(f"Connection error. Code:{errorCode}, Msg:{errorString}")
+            self.connectError = (errorCode, errorString)
+            self.handshake.set()